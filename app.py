@@ -1,24 +1,271 @@
 import os
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, abort, g, Response, stream_with_context
 from sqlalchemy import exc
-import json
+from datetime import date
 from flask_cors import CORS
 from auth import AuthError, requires_auth
 
-from models import db_drop_and_create_all, setup_db, Movies, Actors, Performance
+from models import database_path, db_drop_and_create_all, setup_db, setup_unit_of_work, keyset_page, decode_cursor, actor_filmography, movie_cast, Movies, Actors, Performance
+from search import SEARCHABLE, search, query_words
+from cache import conditional, response_cache
+from idempotency import idempotent
+from instrumentation import setup_instrumentation
+from profiler import setup_profiler
+from serialization import as_dicts, dumps, json_response, jsonify
+from config import pagination_info
+
+DEFAULT_PAGE_SIZE = pagination_info['DEFAULT_PAGE_SIZE']
+MAX_PAGE_SIZE = pagination_info['MAX_PAGE_SIZE']
+EXPORT_BATCH_SIZE = pagination_info['EXPORT_BATCH_SIZE']
+MAX_BATCH_SIZE = pagination_info['MAX_BATCH_SIZE']
+SEARCH_PAGE_SIZE = pagination_info['SEARCH_PAGE_SIZE']
+SEARCH_MAX_OFFSET = pagination_info['SEARCH_MAX_OFFSET']
+
+'''
+List requests
+    ?limit= and ?after= page through the rows, see keyset_page
+    ?sort= orders by one of the sortable fields, prefixed with - for descending (default id)
+    every other known argument filters the rows with a WHERE clause on an indexed column
+    it should abort with 422 for an unknown sort field or an invalid value
+    limit is capped at MAX_PAGE_SIZE, without limit DEFAULT_PAGE_SIZE applies (0 means no paging)
+'''
+def parse_iso_date(value):
+    '''release dates, written or filtered on, are only accepted as an ISO 8601 date string (YYYY-MM-DD)'''
+    if not isinstance(value, str):
+        raise ValueError('not a date string')
+    return date.fromisoformat(value)
+
+
+# integer columns and ids are 32 bit, larger values would fail in the driver
+INTEGER_RANGE = (-2 ** 31, 2 ** 31 - 1)
+
+
+def parse_integer(value):
+    value = int(value)
+    if not INTEGER_RANGE[0] <= value <= INTEGER_RANGE[1]:
+        raise ValueError('integer out of range')
+    return value
+
+
+ACTOR_SORTS = {'id': Actors.id, 'name': Actors.name, 'age': Actors.age}
+ACTOR_FILTERS = {
+    'name': lambda value: Actors.name.startswith(value, autoescape=True),
+    'gender': lambda value: Actors.gender == value,
+    'min_age': lambda value: Actors.age >= parse_integer(value),
+    'max_age': lambda value: Actors.age <= parse_integer(value),
+}
+MOVIE_SORTS = {'id': Movies.id, 'title': Movies.title, 'release_date': Movies.release_date}
+MOVIE_FILTERS = {
+    'title': lambda value: Movies.title.startswith(value, autoescape=True),
+    'released_after': lambda value: Movies.release_date >= parse_iso_date(value),
+    'released_before': lambda value: Movies.release_date <= parse_iso_date(value),
+}
+
+
+def check_cursor(after):
+    '''range checks a decoded cursor, the id alone or the sort value and the id, as the filters are'''
+    if isinstance(after, int):
+        parse_integer(after)
+        return
+    value, last_id = after
+    parse_integer(last_id)
+    # decode_cursor already matched the value to the python type of the sort column
+    if isinstance(value, bool):
+        raise ValueError('invalid cursor')
+    if isinstance(value, int):
+        parse_integer(value)
+
+
+def get_list_args(sorts, filters):
+    '''returns the filter conditions, sort column, descending flag, decoded cursor and page size'''
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    column = sorts.get(sort[1:] if descending else sort)
+    if column is None:
+        abort(422)
+
+    after = request.args.get('after', None)
+    limit = request.args.get('limit', None)
+    try:
+        conditions = [build(request.args[name]) for name, build in filters.items() if name in request.args]
+        after = decode_cursor(after, column) if after is not None else None
+        limit = int(limit) if limit is not None else (DEFAULT_PAGE_SIZE or None)
+        if after is not None:
+            check_cursor(after)
+    except (ValueError, OverflowError):
+        abort(422)
+
+    if limit is not None:
+        if limit < 1:
+            abort(422)
+        limit = min(limit, MAX_PAGE_SIZE)
+    return conditions, column, descending, after, limit
+
+'''
+Projection
+    ?fields= is a comma separated list of the serialize fields of the model to return
+    only those columns are selected, it should abort with 422 for an unknown or empty field
+    without ?fields= every field is returned
+'''
+def get_fields(model):
+    fields = request.args.get('fields', None)
+    if fields is None:
+        return None
+
+    selected = []
+    for field in fields.split(','):
+        field = field.strip()
+        if field not in model.serialize_fields:
+            abort(422)
+        if field not in selected:
+            selected.append(field)
+    return tuple(selected)
+
+
+def page_fields(fields, column):
+    '''the columns keyset_page needs on top of fields to build the next cursor'''
+    if fields is None:
+        return None
+    return fields + tuple(key for key in ('id', column.key) if key not in fields)
+
+'''
+ndjson_response(query)
+streams every row of query as one json document per line
+    query selects column tuples, see the rows() classmethod of the models
+    rows are read through a server side cursor EXPORT_BATCH_SIZE at a time so memory stays flat
+    dates are written in ISO 8601 format
+'''
+def ndjson_response(query):
+    def generate():
+        rows = query.execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+        fields = None
+        for row in rows:
+            if fields is None:
+                fields = row._fields
+            yield dumps(dict(zip(fields, row))) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+'''
+Batch requests
+    the body of a batch request is a json array of at most MAX_BATCH_SIZE items
+    every item is validated before anything is written, a single invalid item fails the whole batch
+    returns the per item results {"index": i, "id": id, "status": status} or {"index": i, "error": message}
+    values are checked, not coerced: a name must be a string and an age or id an integer (not a boolean)
+'''
+def text(value):
+    if not isinstance(value, str):
+        raise ValueError('not a string')
+    return value
+
+
+def integer(value):
+    if not is_id(value):
+        raise ValueError('not an integer')
+    return value
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+ACTOR_FIELDS = {'name': text, 'age': integer, 'gender': text}
+MOVIE_FIELDS = {'title': text, 'release_date': parse_iso_date}
+
+
+def get_batch_body():
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, list) or not body or len(body) > MAX_BATCH_SIZE:
+        abort(422)
+    return body
+
+
+def clean_item(item, fields, partial=False):
+    if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+
+    values = {}
+    if partial:
+        if item.get('id') is None:
+            raise ValueError('id is required')
+        if not is_id(item['id']):
+            raise ValueError('id is invalid')
+        values['id'] = item['id']
+
+    for field, convert in fields.items():
+        if item.get(field) is None:
+            if not partial:
+                raise ValueError('%s is required' % field)
+            continue
+        try:
+            values[field] = convert(item[field])
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError('%s is invalid' % field)
+    return values
+
+
+def clean_batch(items, fields, model=None, partial=False):
+    '''returns the cleaned rows and the per item errors, ids are checked against model'''
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(clean_item(item, fields, partial))
+        except ValueError as error:
+            errors.append({'index': index, 'error': str(error)})
+
+    if model is not None and not errors:
+        existing = model.existing_ids([row['id'] for row in rows])
+        errors = [
+            {'index': index, 'error': 'resource not found'}
+            for index, row in enumerate(rows) if row['id'] not in existing
+        ]
+    return rows, errors
+
+
+def clean_batch_ids(items, model):
+    if not all(is_id(item) for item in items):
+        return [], [{'index': index, 'error': 'id is invalid'}
+                    for index, item in enumerate(items) if not is_id(item)]
+    existing = model.existing_ids(items)
+    return items, [{'index': index, 'error': 'resource not found'}
+                   for index, item in enumerate(items) if item not in existing]
+
+
+def batch_error(errors):
+    return jsonify({
+        'success': False,
+        'error': 422,
+        'message': 'unprocessable',
+        'results': errors
+    }), 422
+
+
+def batch_results(ids, status):
+    return [{'index': index, 'id': id, 'status': status} for index, id in enumerate(ids)]
 
 
 
 def create_app(test_config=None):
-    '''create and configure the app'''
+    '''create and configure the app
+    test_config is merged into app.config, its DATABASE_URL replaces the one of the environment'''
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.update(test_config)
+    setup_db(app, app.config.get('DATABASE_URL', database_path))
+    # changes made by a request are committed once, after the view returns
+    setup_unit_of_work(app)
+    # per route latency, SQL statement counts and GET /metrics
+    setup_instrumentation(app)
+    # opt in SQL profile and slow query log, see profiler.py
+    setup_profiler(app)
     '''
-    To initialize the database uncomment the following line
+    Creating the app does no database I/O, the schema comes from the migrations
+    run python manage.py db upgrade before the first start and after every deploy
+    to reset a development database with sample data uncomment the following line
     NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
-    MUST BE UNCOMMENTED ON FIRST RUN
     '''
-    # db_drop_and_create_all()
+    # with app.app_context(): db_drop_and_create_all()
 
 
 
@@ -44,24 +291,97 @@ def create_app(test_config=None):
     GET /actors
         it should require the 'get:actors' permission
         it should contain the actor.complete data representation
-    returns status code 200 and json {"success": True, "actors": actor} where actors is the list of actors or appropriate status code indicating reason for failure
+        it should accept ?limit= and ?after= to page through the actors ordered by id
+        it should accept ?sort= with id, name or age (-age for descending)
+        it should accept ?name= (prefix), ?gender=, ?min_age= and ?max_age= to filter the actors
+        it should accept ?fields= to return only some of the fields, only those columns are selected
+    returns status code 200 and json {"success": True, "actors": actor, "next_cursor": cursor} where actors is the list of actors
+    and cursor is the ?after= value of the next page (null on the last page) or appropriate status code indicating reason for failure
     '''
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @conditional('actors')
+    @response_cache.cached('actors')
     def actors(jwt):
+        fields = get_fields(Actors)
+        conditions, column, descending, after, limit = get_list_args(ACTOR_SORTS, ACTOR_FILTERS)
         try:
-            actors=Actors.query.all()
-            return jsonify({
+            query = Actors.rows(page_fields(fields, column)).filter(*conditions)
+            actors, next_cursor = keyset_page(query, column, after, limit, descending)
+            return json_response({
                 'success': True,
-                'actors': [actor.serialize for actor in actors]
+                'actors': as_dicts(actors, fields),
+                'next_cursor': next_cursor
             })
-        except:
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
+            abort(404)
+
+    '''
+    GET /actors/export
+        it should require the 'get:actors' permission
+        it should stream every actor ordered by id without building the full list in memory
+    returns status code 200 and application/x-ndjson with one actor.complete data representation per line
+    '''
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    def export_actors(jwt):
+        return ndjson_response(Actors.rows().order_by(Actors.id))
+
+    '''
+    GET /actors/<id>
+        where <id> is the existing model id
+        it should respond with a 404 error if <id> is not found
+        it should require the 'get:actors' permission
+        it should accept ?fields= to return only some of the fields
+    returns status code 200 and json {"success": True, "actor": actor} where actor is the actor.complete data representation
+    '''
+    @app.route('/actors/<int:id>', methods=['GET'])
+    @requires_auth('get:actors')
+    @conditional('actors')
+    @response_cache.cached('actors')
+    def get_actor(jwt, id):
+        fields = get_fields(Actors)
+        row = Actors.rows(fields).filter(Actors.id == id).first()
+
+        if row:
+            return json_response({
+                'success': True,
+                'actor': as_dicts([row])[0]
+            })
+        else:
+            abort(404)
+
+    '''
+    GET /actors/<id>/movies
+        where <id> is the existing model id
+        it should respond with a 404 error if <id> is not found
+        it should require both the 'get:actors' and 'get:movies' permissions
+        it should run the same number of queries however many movies the actor played in
+    returns status code 200 and json {"success": True, "actor": actor, "movies": movies} where movies lists
+    the actor's movies by release date with the rating of each performance
+    '''
+    @app.route('/actors/<int:id>/movies', methods=['GET'])
+    @requires_auth('get:actors', 'get:movies')
+    @conditional('actors', 'movies', 'performance')
+    @response_cache.cached('actors', 'movies', 'performance')
+    def actor_movies(jwt, id):
+        actor = Actors.query.get(id)
+
+        if actor:
+            return json_response({
+                'success': True,
+                'actor': actor.serialize,
+                'movies': as_dicts(actor_filmography(id))
+            })
+        else:
             abort(404)
 
     '''
     POST /actors
         it should create a new row in the actors table
         it should require the 'post:actors' permission
+        it should answer a retry with the same Idempotency-Key header with the first response, see idempotency.py
         it should contain the actor.complete data representation
     returns status code 200 and json {"success": True, "actors": actor} where actor is an array containing only the newly created actor
     or appropriate status code indicating reason for failure
@@ -70,6 +390,7 @@ def create_app(test_config=None):
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @idempotent
     def new_actor(jwt):
         body = request.get_json(force=True)
 
@@ -90,7 +411,8 @@ def create_app(test_config=None):
                 'actor': [actor.serialize]
             })
 
-        except:
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
             abort(422)
 
     '''
@@ -130,7 +452,8 @@ def create_app(test_config=None):
                     'success': True,
                     'actors': [actor.serialize]
                 })
-            except:
+            except Exception:
+                app.logger.exception('%s %s failed', request.method, request.path)
                 abort(422)
         else:
             abort(404)
@@ -157,34 +480,183 @@ def create_app(test_config=None):
                     'success': True,
                     'delete': id
                 })
-            except:
+            except Exception:
+                app.logger.exception('%s %s failed', request.method, request.path)
                 abort(422)
         else:
             abort(404)
     '''
+    POST /actors/batch, PATCH /actors/batch, DELETE /actors/batch
+        it should require the same permission as POST, PATCH and DELETE /actors/<id>
+        POST takes an array of actors, PATCH an array of actors with their id, DELETE an array of ids
+        it should validate every item first and write all of them in a single transaction
+        it should answer a retry with the same Idempotency-Key header with the first response
+    returns status code 200 and json {"success": True, "actors": results} where results has the id and status of each item
+    or status code 422 and the errors of the invalid items, in which case nothing is written
+    '''
+
+    @app.route('/actors/batch', methods=['POST'])
+    @requires_auth('post:actors')
+    @idempotent
+    def batch_new_actors(jwt):
+        rows, errors = clean_batch(get_batch_body(), ACTOR_FIELDS)
+        if errors:
+            return batch_error(errors)
+
+        try:
+            Actors.create_many(rows)
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
+            abort(422)
+        return jsonify({
+            'success': True,
+            'actors': batch_results([row['id'] for row in rows], 'created')
+        })
+
+    @app.route('/actors/batch', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    @idempotent
+    def batch_update_actors(jwt):
+        rows, errors = clean_batch(get_batch_body(), ACTOR_FIELDS, Actors, partial=True)
+        if errors:
+            return batch_error(errors)
+
+        try:
+            Actors.update_many(rows)
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
+            abort(422)
+        return jsonify({
+            'success': True,
+            'actors': batch_results([row['id'] for row in rows], 'updated')
+        })
+
+    @app.route('/actors/batch', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    @idempotent
+    def batch_delete_actors(jwt):
+        ids, errors = clean_batch_ids(get_batch_body(), Actors)
+        if errors:
+            return batch_error(errors)
+
+        try:
+            Actors.delete_many(ids)
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
+            abort(422)
+        return jsonify({
+            'success': True,
+            'actors': batch_results(ids, 'deleted')
+        })
+
+    '''
     GET /movies
         it should require the 'get:movies' permission
         it should contain the movie.complete data representation
-    returns status code 200 and json {"success": True, "movies": movie} where movies is the list of movies or appropriate status code indicating reason for failure
+        it should accept ?limit= and ?after= to page through the movies ordered by id
+        it should accept ?sort= with id, title or release_date (-release_date for descending)
+        it should accept ?title= (prefix), ?released_after= and ?released_before= (inclusive dates) to filter the movies
+        it should accept ?fields= to return only some of the fields, only those columns are selected
+    returns status code 200 and json {"success": True, "movies": movie, "next_cursor": cursor} where movies is the list of movies
+    and cursor is the ?after= value of the next page (null on the last page) or appropriate status code indicating reason for failure
     '''
 
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @conditional('movies')
+    @response_cache.cached('movies')
     def movies(jwt):
+        fields = get_fields(Movies)
+        conditions, column, descending, after, limit = get_list_args(MOVIE_SORTS, MOVIE_FILTERS)
         try:
-            movies=Movies.query.all()
-            return jsonify({
+            query = Movies.rows(page_fields(fields, column)).filter(*conditions)
+            movies, next_cursor = keyset_page(query, column, after, limit, descending)
+            return json_response({
                 'success': True,
-                'movies': [movie.serialize for movie in movies]
+                'movies': as_dicts(movies, fields),
+                'next_cursor': next_cursor
             })
-        except:
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
+            abort(404)
+
+    '''
+    GET /movies/export
+        it should require the 'get:movies' permission
+        it should stream every movie ordered by id without building the full list in memory
+    returns status code 200 and application/x-ndjson with one movie.complete data representation per line
+    '''
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    def export_movies(jwt):
+        return ndjson_response(Movies.rows().order_by(Movies.id))
+
+    '''
+    GET /performances/export
+        it should require both the 'get:actors' and 'get:movies' permissions
+        it should stream every performance ordered by id without building the full list in memory
+    returns status code 200 and application/x-ndjson with one performance data representation per line
+    '''
+    @app.route('/performances/export', methods=['GET'])
+    @requires_auth('get:actors', 'get:movies')
+    def export_performances(jwt):
+        return ndjson_response(Performance.rows().order_by(Performance.id))
+
+    '''
+    GET /movies/<id>
+        where <id> is the existing model id
+        it should respond with a 404 error if <id> is not found
+        it should require the 'get:movies' permission
+        it should accept ?fields= to return only some of the fields
+    returns status code 200 and json {"success": True, "movie": movie} where movie is the movie.complete data representation
+    '''
+    @app.route('/movies/<int:id>', methods=['GET'])
+    @requires_auth('get:movies')
+    @conditional('movies')
+    @response_cache.cached('movies')
+    def get_movie(jwt, id):
+        fields = get_fields(Movies)
+        row = Movies.rows(fields).filter(Movies.id == id).first()
+
+        if row:
+            return json_response({
+                'success': True,
+                'movie': as_dicts([row])[0]
+            })
+        else:
+            abort(404)
+
+    '''
+    GET /movies/<id>/actors
+        where <id> is the existing model id
+        it should respond with a 404 error if <id> is not found
+        it should require both the 'get:actors' and 'get:movies' permissions
+        it should run the same number of queries however big the cast is
+    returns status code 200 and json {"success": True, "movie": movie, "actors": actors} where actors lists
+    the cast of the movie by rating with the rating of each performance
+    '''
+    @app.route('/movies/<int:id>/actors', methods=['GET'])
+    @requires_auth('get:actors', 'get:movies')
+    @conditional('actors', 'movies', 'performance')
+    @response_cache.cached('actors', 'movies', 'performance')
+    def movie_actors(jwt, id):
+        movie = Movies.query.get(id)
+
+        if movie:
+            return json_response({
+                'success': True,
+                'movie': movie.serialize,
+                'actors': as_dicts(movie_cast(id))
+            })
+        else:
             abort(404)
 
     '''
     POST /movies
         it should create a new row in the movies table
         it should require the 'post:movies' permission
+        it should answer a retry with the same Idempotency-Key header with the first response, see idempotency.py
         it should contain the movie.complete data representation
     returns status code 200 and json {"success": True, "movies": movie} where movie is an array containing only the newly created movie
     or appropriate status code indicating reason for failure
@@ -193,6 +665,7 @@ def create_app(test_config=None):
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @idempotent
     def new_movie(jwt):
         body = request.get_json(force=True)
 
@@ -202,15 +675,16 @@ def create_app(test_config=None):
         release_date = body.get('release_date')
 
         try:
-            movie = Movies(title=title, release_date=release_date)
+            movie = Movies(title=title, release_date=parse_iso_date(release_date))
             movie.create()
 
-            return jsonify({
+            return json_response({
                 'success':True,
                 'movies':[movie.serialize]
             })
 
-        except:
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
             abort(422)
 
     '''
@@ -239,15 +713,16 @@ def create_app(test_config=None):
                 if title:
                     movie.title = title
                 if release_date:
-                    movie.release_date = release_date
+                    movie.release_date = parse_iso_date(release_date)
 
                 movie.update()
 
-                return jsonify({
+                return json_response({
                     'success': True,
                     'movies': [movie.serialize]
                 })
-            except:
+            except Exception:
+                app.logger.exception('%s %s failed', request.method, request.path)
                 abort(422)
         else:
             abort(404)
@@ -274,12 +749,118 @@ def create_app(test_config=None):
                     'success': True,
                     'delete': id
                 })
-            except:
+            except Exception:
+                app.logger.exception('%s %s failed', request.method, request.path)
                 abort(422)
         else:
             abort(404)
 
 
+    '''
+    POST /movies/batch, PATCH /movies/batch, DELETE /movies/batch
+        it should require the same permission as POST, PATCH and DELETE /movies/<id>
+        POST takes an array of movies, PATCH an array of movies with their id, DELETE an array of ids
+        it should validate every item first and write all of them in a single transaction
+        it should answer a retry with the same Idempotency-Key header with the first response
+    returns status code 200 and json {"success": True, "movies": results} where results has the id and status of each item
+    or status code 422 and the errors of the invalid items, in which case nothing is written
+    '''
+
+    @app.route('/movies/batch', methods=['POST'])
+    @requires_auth('post:movies')
+    @idempotent
+    def batch_new_movies(jwt):
+        rows, errors = clean_batch(get_batch_body(), MOVIE_FIELDS)
+        if errors:
+            return batch_error(errors)
+
+        try:
+            Movies.create_many(rows)
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
+            abort(422)
+        return jsonify({
+            'success': True,
+            'movies': batch_results([row['id'] for row in rows], 'created')
+        })
+
+    @app.route('/movies/batch', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    @idempotent
+    def batch_update_movies(jwt):
+        rows, errors = clean_batch(get_batch_body(), MOVIE_FIELDS, Movies, partial=True)
+        if errors:
+            return batch_error(errors)
+
+        try:
+            Movies.update_many(rows)
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
+            abort(422)
+        return jsonify({
+            'success': True,
+            'movies': batch_results([row['id'] for row in rows], 'updated')
+        })
+
+    @app.route('/movies/batch', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    @idempotent
+    def batch_delete_movies(jwt):
+        ids, errors = clean_batch_ids(get_batch_body(), Movies)
+        if errors:
+            return batch_error(errors)
+
+        try:
+            Movies.delete_many(ids)
+        except Exception:
+            app.logger.exception('%s %s failed', request.method, request.path)
+            abort(422)
+        return jsonify({
+            'success': True,
+            'movies': batch_results(ids, 'deleted')
+        })
+
+    '''
+    GET /search
+        it should require the 'get:actors' or the 'get:movies' permission
+        it should search the movie titles and actor names the caller may read for every word of ?q=
+        it should accept ?type= movies or actors to search only one of them
+        it should accept ?limit= and ?offset= (at most SEARCH_MAX_OFFSET) to page through the results of each type
+    returns status code 200 and json {"success": True, "movies": movies, "actors": actors, "next_offset": offset}
+    where movies and actors are ranked best match first and offset is the ?offset= of the next page (null on the last page)
+    or status code 422 if ?q= has no words, ?type= is unknown or ?limit= / ?offset= are out of range
+    '''
+    @app.route('/search', methods=['GET'])
+    @requires_auth('get:actors', 'get:movies', any_of=True)
+    @conditional('actors', 'movies')
+    @response_cache.cached('actors', 'movies')
+    def search_catalogue(jwt):
+        text = request.args.get('q', '')
+        kind_filter = request.args.get('type')
+        if kind_filter is not None and kind_filter not in SEARCHABLE:
+            abort(422)
+        kinds = [
+            kind for kind in ('movies', 'actors')
+            if 'get:' + kind in g.principal.permissions and kind_filter in (None, kind)
+        ]
+        try:
+            limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), MAX_PAGE_SIZE)
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            abort(422)
+        if not query_words(text) or limit < 1 or not 0 <= offset <= SEARCH_MAX_OFFSET:
+            abort(422)
+
+        body = {'success': True}
+        next_offset = None
+        for kind in kinds:
+            results = search(kind, text, limit + 1, offset)
+            if len(results) > limit:
+                next_offset = offset + limit
+            body[kind] = [dict(row.serialize, rank=round(rank, 6)) for row, rank in results[:limit]]
+        body['next_offset'] = next_offset
+        return json_response(body)
+
     '''
     Error Handling
     '''
@@ -0,0 +1,27 @@
+'''
+Async serving mode
+Serves the routes of create_app from gevent greenlets, so one worker process keeps thousands of
+connections open while their requests wait on postgres or on the JWKS endpoint
+
+    pip install gevent psycogreen
+    GUNICORN_WORKER_CLASS=gevent GUNICORN_WORKER_CONNECTIONS=2000 gunicorn -c gunicorn.conf.py async_app:app
+
+    the standard library (sockets, the urlopen of the JWKS fetch, locks) is patched to switch to
+    another greenlet instead of blocking, psycogreen does the same for psycopg2 queries
+    concurrent queries are still bounded by DB_POOL_SIZE + DB_MAX_OVERFLOW, the other requests wait
+    for a connection without blocking the worker (see db_pool_checkout_seconds)
+    this module must be imported before any other so the patches apply everywhere
+'''
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import os
+from app import app
+
+
+if __name__ == '__main__':
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(('0.0.0.0', int(os.environ.get('PORT', 5000))), app).serve_forever()
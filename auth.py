@@ -1,9 +1,14 @@
+import hashlib
 import json
-from flask import request, _request_ctx_stack, abort
+import threading
+import time
+from collections import OrderedDict
+from flask import request, _request_ctx_stack, abort, g
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
-from config import auth0_info
+from config import auth0_info, jwks_info, token_cache_info
+from instrumentation import timed_phase
 
 
 AUTH0_DOMAIN = auth0_info['AUTH0_DOMAIN']
@@ -23,6 +28,187 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Key Store
+'''
+JWKSCache
+Keeps the provider's signing keys in memory so requests do not fetch /.well-known/jwks.json
+    keys are refetched once the ttl has passed
+    a token with an unknown kid triggers an early refetch, at most once per min_refresh_interval
+    only one thread fetches at a time, the others wait and reuse its result
+    if a refetch fails the previously fetched keys keep being served
+    url may be https://, http:// (stub server) or file:// (local jwks document)
+'''
+
+
+class JWKSCache:
+    def __init__(self, url, ttl=3600, min_refresh_interval=30, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._rotate_callbacks = []
+
+    def on_rotate(self, callback):
+        """Registers callback(removed_kids) to be called when a refetch drops keys"""
+        self._rotate_callbacks.append(callback)
+
+    def load(self):
+        """Fetches and parses the JWKS document"""
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def get_key(self, kid):
+        """Returns the rsa key for kid or None if the provider does not know it"""
+        key = self._keys.get(kid)
+        if key is None or self._is_stale():
+            self.refresh(kid)
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self, kid=None):
+        with self._lock:
+            # another thread may have refreshed while this one was waiting on the lock
+            if not self._is_stale() and (kid is None or kid in self._keys):
+                return
+            # unknown kids and a failing provider must not turn into a refetch per request
+            now = time.monotonic()
+            if (self._keys and self._last_attempt is not None
+                    and now - self._last_attempt < self.min_refresh_interval):
+                return
+            self._last_attempt = now
+            try:
+                jwks = self.load()
+            except Exception:
+                if not self._keys:
+                    raise
+                return
+            finally:
+                self.fetch_count += 1
+            previous_kids = set(self._keys)
+            self._keys = {
+                key['kid']: {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key['use'],
+                    'n': key['n'],
+                    'e': key['e']
+                }
+                for key in jwks['keys'] if 'kid' in key
+            }
+            self._fetched_at = now
+            removed_kids = previous_kids - set(self._keys)
+            if removed_kids:
+                for callback in self._rotate_callbacks:
+                    callback(removed_kids)
+
+    def clear(self):
+        with self._lock:
+            removed_kids = set(self._keys)
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+            for callback in self._rotate_callbacks:
+                callback(removed_kids)
+
+    def _is_stale(self):
+        return self._fetched_at is None or time.monotonic() - self._fetched_at >= self.ttl
+
+
+jwks_cache = JWKSCache(
+    jwks_info['JWKS_URL'],
+    ttl=jwks_info['JWKS_TTL'],
+    min_refresh_interval=jwks_info['JWKS_MIN_REFRESH_INTERVAL'],
+    timeout=jwks_info['JWKS_TIMEOUT']
+)
+
+
+# Verified Token Cache
+'''
+TokenCache
+Bounded LRU of payloads whose RS256 signature has already been verified
+    entries are keyed by the sha256 of the token so raw tokens are never kept in memory
+    the cached value is the Principal built from the payload, so claims are parsed once per token
+    an entry lives until the token's exp claim, expired entries are dropped on lookup
+    entries signed by a kid that disappears from the JWKS are evicted
+    max_size 0 disables the cache
+'''
+
+
+class TokenCache:
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def token_key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        """Returns the cached Principal for token or None"""
+        key = self.token_key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            principal, expires_at, kid = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return principal
+
+    def put(self, token, principal, kid):
+        expires_at = principal.expires_at
+        if self.max_size <= 0 or expires_at is None:
+            return
+        key = self.token_key(token)
+        with self._lock:
+            self._entries[key] = (principal, expires_at, kid)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def evict_kids(self, kids):
+        """Drops every entry verified with one of kids"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry[2] in kids]
+            for key in stale:
+                del self._entries[key]
+            self.evictions += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+token_cache = TokenCache(max_size=token_cache_info['TOKEN_CACHE_SIZE'])
+jwks_cache.on_rotate(token_cache.evict_kids)
+
+
 # Auth Header
 
 '''
@@ -69,10 +255,54 @@ def get_token_auth_header():
     return token
 
 
+# Principal
+'''
+Principal
+The caller behind a verified token
+    it is built once per token and cached with it in token_cache
+    permissions is a frozenset so every permission check is a set lookup
+    permissions is None when the token has no permissions claim
+'''
+
+
+class Principal:
+    __slots__ = ('payload', 'subject', 'permissions', 'expires_at')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.subject = payload.get('sub')
+        permissions = payload.get('permissions')
+        self.permissions = frozenset(permissions) if permissions is not None else None
+        expires_at = payload.get('exp')
+        self.expires_at = expires_at if isinstance(expires_at, (int, float)) else None
+
+    def require(self, required, any_of=False):
+        """Raises an AuthError unless the principal holds all (or with any_of, one) of required"""
+        if self.permissions is None:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Permissions not included in JWT.'
+            }, 400)
+
+        if any_of:
+            allowed = not required or not self.permissions.isdisjoint(required)
+        else:
+            allowed = required <= self.permissions
+        if not allowed:
+            raise AuthError({
+                'code': 'unauthorized',
+                'description': 'Permission not found.'
+            }, 403)
+        return True
+
+    def __repr__(self):
+        return '<Principal %r>' % self.subject
+
+
 '''
     @INPUTS
         permission: string permission (i.e. 'post:drink')
-        payload: decoded jwt payload
+        payload: decoded jwt payload or Principal
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
@@ -82,18 +312,8 @@ def get_token_auth_header():
 
 
 def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
-
-    if permission not in payload['permissions']:
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission not found.'
-        }, 403)
-    return True
+    principal = payload if isinstance(payload, Principal) else Principal(payload)
+    return principal.require(frozenset([permission]))
 
 
 '''
@@ -102,7 +322,8 @@ def check_permissions(permission, payload):
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using Auth0 /.well-known/jwks.json (cached by jwks_cache)
+    tokens that were already verified are served from token_cache until they expire
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -112,30 +333,45 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return verify_principal(token).payload
+
+
+'''
+verify_principal(token)
+    returns the Principal for token
+    tokens that were already verified are served from token_cache, others go through decode_jwt
+'''
+
 
+def verify_principal(token):
+    principal = token_cache.get(token)
+    if principal is None:
+        payload, kid = decode_jwt(token)
+        principal = Principal(payload)
+        token_cache.put(token, principal, kid)
+    return principal
+
+
+'''
+decode_jwt(token)
+    verifies the signature and claims of token
+    returns the decoded payload and the kid of the key that signed it
+'''
+
+
+def decode_jwt(token):
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
     # CHOOSE OUR KEY
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # GET THE PUBLIC KEY FROM THE CACHED AUTH0 JWKS
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     # Finally, verify!!!
     if rsa_key:
         try:
@@ -148,7 +384,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
-            return payload
+            return payload, rsa_key['kid']
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -175,31 +411,37 @@ def verify_decode_jwt(token):
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permissions: one or more string permissions (i.e. 'post:drink')
+        any_of: when True one of the permissions is enough, otherwise all of them are required
 
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
-    it should use the check_permissions method validate claims and check the requested permission
+    it should use the verify_principal method to decode the jwt
+    it should use the Principal.require method validate claims and check the requested permissions
+    the current Principal is available to the view as g.principal
     return the decorator which passes the decoded payload to the decorated method
 '''
 
 
-def requires_auth(permission=''):
+def requires_auth(*permissions, any_of=False):
+    required = frozenset(permission for permission in permissions if permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except:
-                raise AuthError({
-                    'code': 'invalid_token',
-                    'description': 'Access denied due to invalid token'
-                }, 401)
-
-            check_permissions(permission, payload)
-
-            return f(payload, *args, **kwargs)
+            with timed_phase('auth'):
+                token = get_token_auth_header()
+                try:
+                    principal = verify_principal(token)
+                except Exception:
+                    raise AuthError({
+                        'code': 'invalid_token',
+                        'description': 'Access denied due to invalid token'
+                    }, 401)
+
+                principal.require(required, any_of)
+                g.principal = principal
+
+            return f(principal.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
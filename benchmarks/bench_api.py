@@ -0,0 +1,280 @@
+'''
+API benchmark
+Seeds a synthetic dataset, starts the API with gunicorn.conf.py against it, mints local RS256
+tokens whose keys a stub JWKS server publishes, then drives every endpoint for --duration seconds
+at --concurrency concurrent clients.
+
+    python benchmarks/bench_api.py --database-url postgresql://localhost/casting_bench \
+        --actors 100000 --movies 100000 --performances 1000000 --concurrency 16 --output bench.json
+
+THE TABLES OF --database-url ARE DROPPED AND RECREATED, never point it at real data.
+GET requests send Cache-Control: no-cache unless --use-cache is given, so they measure the work
+of the endpoint and not the response cache.
+Writes a json report with the throughput and latency percentiles (ms) of every endpoint and the
+commit it ran on, compare two reports to find a regression.
+'''
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from bench_indexes import insert_chunks, percentiles
+from local_auth import LocalSigner
+from models import db, setup_db, Movies, Actors, Performance
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PERMISSIONS = (
+    'get:actors', 'get:movies', 'post:actors', 'post:movies',
+    'patch:actors', 'patch:movies', 'delete:actors', 'delete:movies'
+)
+
+
+def seed(database_url, actors, movies, performances):
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        first_release = date(1950, 1, 1)
+        insert_chunks(Movies.__table__, (
+            {'id': id, 'title': 'Movie %d' % id, 'release_date': first_release + timedelta(days=id % 25000)}
+            for id in range(1, movies + 1)
+        ))
+        insert_chunks(Actors.__table__, (
+            {'id': id, 'name': 'Actor %d' % id, 'age': 18 + id % 60, 'gender': 'Female' if id % 2 else 'Male'}
+            for id in range(1, actors + 1)
+        ))
+        # distinct (movie, actor) pairs: performance i is actor i % actors in movie i // actors
+        insert_chunks(Performance.__table__, (
+            {'movie_id': index // actors % movies + 1, 'actor_id': index % actors + 1, 'rating': index % 100}
+            for index in range(min(performances, actors * movies))
+        ))
+        if db.engine.dialect.name == 'postgresql':
+            # the explicit ids above do not advance the sequences
+            for table in ('movies', 'actors', 'performance'):
+                db.session.execute("SELECT setval('%s_id_seq', (SELECT max(id) FROM %s))" % (table, table))
+            db.session.commit()
+            db.session.execute('ANALYZE')
+        db.engine.dispose()
+
+
+class StubJWKS(ThreadingHTTPServer):
+    '''serves the JWKS document of signer on http://127.0.0.1:<port>/jwks.json'''
+
+    def __init__(self, signer):
+        body = json.dumps(signer.jwks()).encode('utf-8')
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/jwks.json' % self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(database_url, jwks_url, workers, timeout=60):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=database_url, JWKS_URL=jwks_url, PORT=str(port), WEB_CONCURRENCY=str(workers))
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                               cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = 'http://127.0.0.1:%d' % port
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with status %d' % process.returncode)
+        try:
+            with urlopen(base_url + '/', timeout=1):
+                return process, base_url
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('gunicorn did not start in time')
+
+
+def endpoints(actors, movies):
+    '''(name, method, path, body) factories, every call picks new random ids'''
+    actor = lambda: random.randint(1, actors)
+    movie = lambda: random.randint(1, movies)
+    new_actor = lambda: {'name': 'Bench Actor', 'age': random.randint(18, 80), 'gender': 'Female'}
+    new_movie = lambda: {'title': 'Bench Movie', 'release_date': '2020-05-19'}
+    return [
+        ('GET /', 'GET', lambda: '/', None),
+        ('GET /actors', 'GET', lambda: '/actors?limit=50&after=%d' % actor(), None),
+        ('GET /actors sorted', 'GET', lambda: '/actors?sort=-age&limit=50', None),
+        ('GET /actors filtered', 'GET', lambda: '/actors?name=Actor%%20%d&limit=50' % actor(), None),
+        ('GET /actors/<id>', 'GET', lambda: '/actors/%d?fields=id,name' % actor(), None),
+        ('GET /actors/<id>/movies', 'GET', lambda: '/actors/%d/movies' % actor(), None),
+        ('GET /movies', 'GET', lambda: '/movies?limit=50&after=%d' % movie(), None),
+        ('GET /movies sorted', 'GET', lambda: '/movies?sort=-release_date&limit=50', None),
+        ('GET /movies/<id>', 'GET', lambda: '/movies/%d' % movie(), None),
+        ('GET /movies/<id>/actors', 'GET', lambda: '/movies/%d/actors' % movie(), None),
+        ('GET /search', 'GET', lambda: '/search?q=movie%%20%d' % movie(), None),
+        ('GET /actors/export', 'GET', lambda: '/actors/export', None),
+        ('GET /movies/export', 'GET', lambda: '/movies/export', None),
+        ('GET /performances/export', 'GET', lambda: '/performances/export', None),
+        ('POST /actors', 'POST', lambda: '/actors', new_actor),
+        ('POST /movies', 'POST', lambda: '/movies', new_movie),
+        ('POST /actors/batch', 'POST', lambda: '/actors/batch', lambda: [new_actor() for _ in range(10)]),
+        ('POST /movies/batch', 'POST', lambda: '/movies/batch', lambda: [new_movie() for _ in range(10)]),
+        ('PATCH /actors/<id>', 'PATCH', lambda: '/actors/%d' % actor(), lambda: {'age': random.randint(18, 80)}),
+        ('PATCH /movies/<id>', 'PATCH', lambda: '/movies/%d' % movie(), lambda: {'title': 'Renamed Movie'}),
+        ('PATCH /actors/batch', 'PATCH', lambda: '/actors/batch',
+            lambda: [{'id': id, 'age': 30} for id in random.sample(range(1, actors + 1), min(10, actors))]),
+        ('PATCH /movies/batch', 'PATCH', lambda: '/movies/batch',
+            lambda: [{'id': id, 'title': 'Renamed'} for id in random.sample(range(1, movies + 1), min(10, movies))]),
+        # the deletes run last and remove rows from the top of the id range
+        ('DELETE /actors/<id>', 'DELETE', None, None),
+        ('DELETE /movies/<id>', 'DELETE', None, None),
+    ]
+
+
+def drive(base_url, headers, method, path, body, concurrency, duration):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        own = []
+        failed = 0
+        while time.perf_counter() < deadline:
+            data = json.dumps(body()).encode('utf-8') if body else None
+            request = Request(base_url + path(), data=data, method=method, headers=headers)
+            start = time.perf_counter()
+            try:
+                with urlopen(request, timeout=60) as response:
+                    response.read()
+            except (HTTPError, OSError):
+                failed += 1
+            own.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    report = {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput_rps': round(len(latencies) / elapsed, 1)
+    }
+    if latencies:
+        report['latency_ms'] = percentiles(latencies)
+    return report
+
+
+def descending_ids(last):
+    '''a thread safe path factory handing out ids from last down, for the deletes'''
+    ids = iter(range(last, 0, -1))
+    lock = threading.Lock()
+
+    def next_id():
+        with lock:
+            return next(ids, 1)
+    return next_id
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--performances', type=int, default=100000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per endpoint')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--use-cache', action='store_true')
+    parser.add_argument('--skip-seed', action='store_true', help='reuse the dataset of a previous run')
+    parser.add_argument('--only', help='run only the endpoints whose name contains this text')
+    parser.add_argument('--output', help='file to write the report to, stdout by default')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        start = time.perf_counter()
+        seed(args.database_url, args.actors, args.movies, args.performances)
+        seed_seconds = round(time.perf_counter() - start, 1)
+    else:
+        seed_seconds = None
+
+    signer = LocalSigner()
+    jwks = StubJWKS(signer)
+    headers = dict(signer.bearer(*PERMISSIONS, expires_in=24 * 3600), **{'Content-Type': 'application/json'})
+    if not args.use_cache:
+        headers['Cache-Control'] = 'no-cache'
+
+    process, base_url = start_server(args.database_url, jwks.url, args.workers)
+    results = {}
+    try:
+        for name, method, path, body in endpoints(args.actors, args.movies):
+            if args.only and args.only not in name:
+                continue
+            if method == 'DELETE':
+                ids = descending_ids(args.actors if 'actors' in name else args.movies)
+                kind = 'actors' if 'actors' in name else 'movies'
+                path = lambda kind=kind, ids=ids: '/%s/%d' % (kind, ids())
+            results[name] = drive(base_url, headers, method, path, body, args.concurrency, args.duration)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(30)
+        jwks.shutdown()
+
+    report = json.dumps({
+        'commit': git_commit(),
+        'dataset': {'actors': args.actors, 'movies': args.movies, 'performances': args.performances},
+        'seed_seconds': seed_seconds,
+        'concurrency': args.concurrency,
+        'duration_seconds': args.duration,
+        'workers': args.workers,
+        'response_cache': args.use_cache,
+        'endpoints': results
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Gunicorn startup and memory benchmark
+Starts gunicorn with gunicorn.conf.py, with GUNICORN_PRELOAD on and off, and measures the time
+until every worker is up and the first response is served, then the memory of the master and
+its workers.
+
+    DATABASE_URL=postgresql://localhost/casting_agency python benchmarks/bench_gunicorn.py --workers 4
+
+Linux only, memory is read from /proc. pss shares the pages of a preloaded master between the
+processes that map them, rss counts them in every process.
+Prints a json report per mode.
+'''
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from urllib.request import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def children(pid):
+    with open('/proc/%d/task/%d/children' % (pid, pid)) as children_file:
+        return [int(child) for child in children_file.read().split()]
+
+
+def memory_kb(pid):
+    '''returns the (rss, pss) of pid in kB'''
+    values = {}
+    with open('/proc/%d/smaps_rollup' % pid) as smaps:
+        for line in smaps:
+            name, _, rest = line.partition(':')
+            if name in ('Rss', 'Pss'):
+                values[name] = int(rest.split()[0])
+    return values['Rss'], values['Pss']
+
+
+def wait_until_ready(process, port, workers, deadline):
+    url = 'http://127.0.0.1:%d/' % port
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with status %d' % process.returncode)
+        try:
+            if len(children(process.pid)) >= workers:
+                with urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return
+        except OSError:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError('gunicorn did not start in time')
+
+
+def measure(preload, workers, timeout):
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers), GUNICORN_PRELOAD='1' if preload else '0')
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_until_ready(process, port, workers, start + timeout)
+        ready_seconds = time.perf_counter() - start
+        # let the workers that did not serve the first request finish booting
+        time.sleep(1)
+        pids = [process.pid] + children(process.pid)
+        usage = [memory_kb(pid) for pid in pids]
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout)
+
+    return {
+        'preload': preload,
+        'workers': workers,
+        'ready_seconds': round(ready_seconds, 3),
+        'rss_mb': round(sum(rss for rss, pss in usage) / 1024, 1),
+        'pss_mb': round(sum(pss for rss, pss in usage) / 1024, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    print(json.dumps([measure(preload, args.workers, args.timeout) for preload in (False, True)], indent=2))
+
+
+if __name__ == '__main__':
+    main()
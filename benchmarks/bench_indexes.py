@@ -0,0 +1,154 @@
+'''
+Index benchmark
+Measures cast/filmography join latency and actor cascade delete latency with and
+without the indexes added by migration 988100038146 on a seeded dataset.
+
+    python benchmarks/bench_indexes.py --database-url postgresql://localhost/casting_bench --performances 1000000
+
+THE TABLES OF --database-url ARE DROPPED AND RECREATED, never point it at real data.
+Prints a json report with the latency percentiles (ms) of each phase.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, setup_db, actor_filmography, movie_cast, Movies, Actors, Performance
+
+CHUNK_SIZE = 10000
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))], 3)
+    return {
+        'count': len(samples),
+        'mean': round(sum(samples) / len(samples), 3),
+        'p50': at(0.50),
+        'p95': at(0.95),
+        'p99': at(0.99)
+    }
+
+
+def insert_chunks(table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+    db.session.commit()
+
+
+def seed(performances):
+    '''every movie gets the same number of distinct actors'''
+    cast_size = 20
+    movies = max(1, performances // cast_size)
+    actors = max(cast_size, movies)
+    first_release = date(1950, 1, 1)
+
+    insert_chunks(Movies.__table__, (
+        {'id': id, 'title': 'Movie %d' % id, 'release_date': first_release + timedelta(days=id % 25000)}
+        for id in range(1, movies + 1)
+    ))
+    insert_chunks(Actors.__table__, (
+        {'id': id, 'name': 'Actor %d' % id, 'age': 18 + id % 60, 'gender': 'Female' if id % 2 else 'Male'}
+        for id in range(1, actors + 1)
+    ))
+    insert_chunks(Performance.__table__, (
+        {'movie_id': movie_id, 'actor_id': (movie_id * 31 + k) % actors + 1, 'rating': (movie_id + k) % 100}
+        for movie_id in range(1, movies + 1)
+        for k in range(cast_size)
+    ))
+    return movies, actors
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def delete_actor(actor_id):
+    Actors.query.get(actor_id).delete()
+
+
+def measure(movies, actors, samples):
+    movie_ids = [random.randint(1, movies) for _ in range(samples)]
+    actor_ids = [random.randint(1, actors) for _ in range(samples)]
+
+    report = {
+        'cast_ms': percentiles([timed(movie_cast, id) for id in movie_ids]),
+        'filmography_ms': percentiles([timed(actor_filmography, id) for id in actor_ids]),
+    }
+    delete_samples = []
+    for id in actor_ids:
+        delete_samples.append(timed(delete_actor, id))
+        # keep the dataset identical for the next sample and phase
+        db.session.rollback()
+    report['delete_actor_ms'] = percentiles(delete_samples)
+    return report
+
+
+def set_indexes(engine, indexes, present):
+    for index in indexes:
+        if present:
+            index.create(bind=engine)
+        else:
+            index.drop(bind=engine)
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            connection.execute('ANALYZE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--performances', type=int, default=1000000)
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, args.database_url)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        indexes = [
+            index
+            for table in (Movies.__table__, Actors.__table__, Performance.__table__)
+            for index in table.indexes
+        ]
+
+        start = time.perf_counter()
+        movies, actors = seed(args.performances)
+        seed_seconds = time.perf_counter() - start
+
+        set_indexes(db.engine, indexes, present=False)
+        before = measure(movies, actors, args.samples)
+        set_indexes(db.engine, indexes, present=True)
+        after = measure(movies, actors, args.samples)
+        dialect = db.engine.dialect.name
+
+    print(json.dumps({
+        'dialect': dialect,
+        'performances': movies * 20,
+        'movies': movies,
+        'actors': actors,
+        'seed_seconds': round(seed_seconds, 1),
+        'indexes': sorted(index.name for index in indexes),
+        'before': before,
+        'after': after
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
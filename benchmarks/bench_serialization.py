@@ -0,0 +1,87 @@
+'''
+Serialization benchmark
+Compares the time to serialize every movie of a seeded table through the old path
+(ORM objects, serialize and jsonify) and the column tuple path of serialization.py
+with the stdlib json encoder and with orjson.
+
+    python benchmarks/bench_serialization.py --rows 10000 100000
+
+--database-url defaults to an in memory sqlite database.
+THE TABLES OF --database-url ARE DROPPED AND RECREATED, never point it at real data.
+Prints a json report with the latency percentiles (ms) of each path and row count.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, jsonify
+from models import db, setup_db, Movies
+from serialization import as_dicts, json_dumps, orjson, orjson_dumps
+from bench_indexes import insert_chunks, percentiles
+
+
+def orm_jsonify():
+    return jsonify({'movies': [movie.serialize for movie in Movies.query.order_by(Movies.id)]}).get_data()
+
+
+def tuples_json():
+    return json_dumps({'movies': as_dicts(Movies.rows().order_by(Movies.id).all())})
+
+
+def tuples_orjson():
+    return orjson_dumps({'movies': as_dicts(Movies.rows().order_by(Movies.id).all())})
+
+
+PATHS = {'orm_jsonify': orm_jsonify, 'tuples_json': tuples_json}
+if orjson is not None:
+    PATHS['tuples_orjson'] = tuples_orjson
+
+
+def seed(rows):
+    db.session.query(Movies).delete()
+    first_release = date(1950, 1, 1)
+    insert_chunks(Movies.__table__, (
+        {'id': id, 'title': 'Movie %d' % id, 'release_date': first_release + timedelta(days=id % 25000)}
+        for id in range(1, rows + 1)
+    ))
+
+
+def measure(path, samples):
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        path()
+        timings.append((time.perf_counter() - start) * 1000)
+        # every sample loads the rows again instead of reading the identity map
+        db.session.expunge_all()
+    return percentiles(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default='sqlite://')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--samples', type=int, default=10)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, args.database_url)
+    report = {'paths': sorted(PATHS), 'results': {}}
+    with app.test_request_context():
+        db.drop_all()
+        db.create_all()
+        report['dialect'] = db.engine.dialect.name
+        for rows in args.rows:
+            seed(rows)
+            report['results'][rows] = {name: measure(path, args.samples) for name, path in PATHS.items()}
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+'''
+Startup benchmark
+Measures the cold start of a fresh interpreter: the time to import app.py (which creates the app),
+the time to the first response of GET / and the SQL statements run before that response.
+
+    DATABASE_URL=postgresql://localhost/casting_agency python benchmarks/bench_startup.py --runs 20
+
+Prints a json report with the percentiles (ms) of each phase.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_indexes import percentiles
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in the child interpreter, the engine event counts every statement of every engine
+CHILD = '''
+import json, time
+start = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/')
+responded = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_response_ms': (responded - start) * 1000,
+    'statements': len(statements)
+}))
+'''
+
+
+def run_once():
+    output = subprocess.check_output([sys.executable, '-c', CHILD], cwd=ROOT)
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    print(json.dumps({
+        'import_ms': percentiles([run['import_ms'] for run in runs]),
+        'first_response_ms': percentiles([run['first_response_ms'] for run in runs]),
+        'statements_before_first_response': max(run['statements'] for run in runs)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, g, make_response
+from datetime import timezone
+from config import cache_info
+from metrics import counter
+from models import TableVersion
+
+'''
+Response cache
+GET responses are cached by route, query arguments, the caller's permissions and the
+    TableVersion of the tables the route reads, a commit that writes to one of them bumps
+    its version so the entries made before it are never served again, whichever worker
+    or process wrote
+    the in process LRU backend is the default, RESPONSE_CACHE_URL=redis://... shares the
+    cache between workers (needs the redis package)
+    entries expire after RESPONSE_CACHE_TTL seconds
+    RESPONSE_CACHE_ENABLED=0 turns the cache off, a request with Cache-Control: no-cache bypasses it
+'''
+
+cache_hits = counter('response_cache_hits_total', 'GET responses served from the response cache')
+cache_misses = counter('response_cache_misses_total', 'GET responses computed and stored in the response cache')
+cache_bypasses = counter('response_cache_bypasses_total', 'GET responses computed without the response cache')
+
+
+class LRUBackend:
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    def __init__(self, url, ttl=60, prefix='casting_agency:cache:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class ResponseCache:
+    def __init__(self, backend, enabled=True):
+        self.backend = backend
+        self.enabled = enabled
+
+    def bypassed(self):
+        return not self.enabled or 'no-cache' in request.headers.get('Cache-Control', '')
+
+    def cached(self, *tables):
+        '''
+        decorator for GET views that only read tables
+        put it under @requires_auth so the key includes the caller's permissions
+        '''
+        tables = sorted(tables)
+
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.bypassed():
+                    cache_bypasses.inc()
+                    return f(*args, **kwargs)
+
+                # the versions are read before the view runs, so a write that commits
+                # while it runs leaves the stored entry under an outdated key
+                key = version_key(tables, table_versions(tables))
+                body = self.backend.get(key)
+                if body is not None:
+                    cache_hits.inc()
+                    response = make_response(body)
+                    response.mimetype = 'application/json'
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                cache_misses.inc()
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.backend.set(key, response.get_data())
+                response.headers['X-Cache'] = 'MISS'
+                return response
+
+            return wrapper
+        return cached_decorator
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = cache_hits.value + cache_misses.value
+        return {
+            'hits': cache_hits.value,
+            'misses': cache_misses.value,
+            'bypasses': cache_bypasses.value,
+            'hit_ratio': cache_hits.value / lookups if lookups else 0.0
+        }
+
+
+'''
+table_versions(tables)
+the {table_name: (version, updated_at)} of tables, read once per request
+    conditional and ResponseCache.cached share them, so the ETag and the cached body
+    always belong to the same versions
+version_key(tables, versions)
+sha256 of the route, the query arguments, the caller's permissions and the versions of tables
+'''
+def table_versions(tables):
+    if 'table_versions' not in g:
+        g.table_versions = {}
+    key = tuple(tables)
+    if key not in g.table_versions:
+        g.table_versions[key] = TableVersion.current(tables)
+    return g.table_versions[key]
+
+
+def version_key(tables, versions):
+    permissions = g.principal.permissions if 'principal' in g else ()
+    parts = [
+        request.path,
+        '&'.join('%s=%s' % item for item in sorted(request.args.items(multi=True))),
+        ' '.join(sorted(permissions or ())),
+        ' '.join('%s:%d' % (table, versions.get(table, (0, None))[0]) for table in tables)
+    ]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+'''
+conditional(*tables)
+decorator for GET views that only read tables, it sends a strong ETag and Last-Modified
+derived from the TableVersion of the tables and answers If-None-Match / If-Modified-Since
+with 304 Not Modified without running the view
+    If-None-Match uses the weak comparison, so a W/ validator matches too
+    If-None-Match: * matches any current representation, so the view runs and only a 200 becomes a 304
+    the ETag also covers the route, the query arguments and the caller's permissions
+    put it under @requires_auth and above @response_cache.cached
+'''
+def conditional(*tables):
+    tables = sorted(tables)
+
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions = table_versions(tables)
+            etag = version_key(tables, versions)[:32]
+            updated = [updated_at for version, updated_at in versions.values()]
+            last_modified = max(updated).replace(microsecond=0) if updated else None
+
+            if not request.if_none_match.star_tag and not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if request.if_none_match.star_tag:
+                    response = make_response('', 304)
+
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since is None or last_modified is None:
+        return False
+    return last_modified <= since.replace(tzinfo=None)
+
+
+def create_backend():
+    if cache_info['RESPONSE_CACHE_URL']:
+        return RedisBackend(cache_info['RESPONSE_CACHE_URL'], ttl=cache_info['RESPONSE_CACHE_TTL'])
+    return LRUBackend(max_size=cache_info['RESPONSE_CACHE_SIZE'], ttl=cache_info['RESPONSE_CACHE_TTL'])
+
+
+response_cache = ResponseCache(create_backend(), enabled=cache_info['RESPONSE_CACHE_ENABLED'])
@@ -0,0 +1,70 @@
+'''
+Gunicorn settings
+    gunicorn -c gunicorn.conf.py app:app
+every setting can be overridden with the environment variables below
+
+    GUNICORN_PRELOAD=1 imports the app once in the master and forks the workers from it, they share
+    its memory pages and start faster. The connections the master opened are closed before the fork
+    and each worker starts with an empty pool (see pre_fork and post_fork)
+    GUNICORN_WORKER_CLASS is sync, gthread (GUNICORN_THREADS threads per worker) or gevent
+    gevent has to patch the standard library before the app is imported, run it with async_app:app,
+    preload is off by default for it
+    max_requests restarts a worker after that many requests, the jitter spreads the restarts so the
+    workers do not all restart at once
+'''
+import multiprocessing
+import os
+import sys
+from importlib.util import find_spec
+
+
+def env_flag(name, default):
+    return os.environ.get(name, default) not in ('0', 'false', 'False')
+
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '8000')
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))  # gevent only
+
+# fail in the master with the reason instead of in every worker it boots
+if worker_class == 'gevent':
+    missing = [module for module in ('gevent', 'psycogreen') if find_spec(module) is None]
+    if missing:
+        raise RuntimeError('GUNICORN_WORKER_CLASS=gevent needs %s, pip install -r requirements.txt' % ' and '.join(missing))
+
+preload_app = env_flag('GUNICORN_PRELOAD', '0' if worker_class == 'gevent' else '1')
+
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))  # seconds, keep above 0 behind a load balancer that reuses connections
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+
+def dispose_app_engines():
+    # nothing to dispose unless the app was preloaded in this process
+    if 'app' not in sys.modules:
+        return
+    from app import app
+    from models import dispose_engines
+    dispose_engines(app)
+
+
+def pre_fork(server, worker):
+    # close the connections of the master, a forked worker must never share one of its sockets
+    dispose_app_engines()
+
+
+def post_fork(server, worker):
+    # the worker starts with an empty pool of its own
+    dispose_app_engines()
+
+
+def post_worker_init(worker):
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,103 @@
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import request, g, jsonify, make_response
+from sqlalchemy import exc
+from config import idempotency_info
+from metrics import counter
+from models import db, IdempotencyKey
+
+'''
+Idempotency keys
+A create or batch request sent with an Idempotency-Key header is answered once,
+a retry with the same key gets the stored response without touching the other tables
+    keys are scoped to the caller (the sub of its token), the method and the path
+    a retry whose body differs from the first request is rejected with 422
+    a retry that arrives while the first request is still running gets 409, it may be retried
+    only successful responses are stored, a failed request rolls the key back with its writes
+    so it can be retried with the same key
+    keys expire after IDEMPOTENCY_TTL seconds
+'''
+
+HEADER = 'Idempotency-Key'
+
+idempotent_replays = counter('idempotent_replays_total', 'Responses replayed for a retried Idempotency-Key')
+idempotent_conflicts = counter('idempotent_conflicts_total', 'Retried Idempotency-Keys rejected as in progress or with a different body')
+
+
+def request_key(value):
+    subject = g.principal.subject if 'principal' in g else ''
+    parts = [subject or '', request.method, request.path, value]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def expired_before():
+    return datetime.utcnow() - timedelta(seconds=idempotency_info['IDEMPOTENCY_TTL'])
+
+
+def key_error(status, message):
+    idempotent_conflicts.inc()
+    return jsonify({
+        'success': False,
+        'error': status,
+        'message': message
+    }), status
+
+
+def replay(row, request_hash):
+    if row.request_hash != request_hash:
+        return key_error(422, 'Idempotency-Key was used with a different request body')
+    if row.status is None:
+        return key_error(409, 'a request with this Idempotency-Key is in progress')
+    idempotent_replays.inc()
+    response = make_response(row.body, row.status)
+    response.mimetype = 'application/json'
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+'''
+idempotent
+decorator for the POST and batch views, put it under @requires_auth so the key includes the caller
+without the header the view runs as usual
+'''
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        value = request.headers.get(HEADER)
+        if value is None:
+            return f(*args, **kwargs)
+        if not value or len(value) > idempotency_info['IDEMPOTENCY_KEY_MAX_LENGTH']:
+            return key_error(422, 'Idempotency-Key must have 1 to %d characters' % idempotency_info['IDEMPOTENCY_KEY_MAX_LENGTH'])
+
+        key = request_key(value)
+        request_hash = hashlib.sha256(request.get_data()).hexdigest()
+        cutoff = expired_before()
+
+        row = IdempotencyKey.find(key, cutoff)
+        if row is not None:
+            return replay(row, request_hash)
+
+        # the key row is inserted before the view writes, a concurrent request with the same
+        # key waits on it and fails here once the first one ends
+        try:
+            IdempotencyKey.reserve(key, request_hash, cutoff)
+        except exc.IntegrityError:
+            db.session.rollback()
+            row = IdempotencyKey.find(key, cutoff)
+            if row is not None:
+                return replay(row, request_hash)
+            return key_error(409, 'a request with this Idempotency-Key is in progress')
+
+        response = make_response(f(*args, **kwargs))
+        # stored in the transaction of the view, the unit of work commits both or neither
+        if response.status_code < 400:
+            IdempotencyKey.store(key, response.status_code, response.get_data())
+        return response
+
+    return wrapper
+
+
+def purge_expired_keys():
+    '''deletes the expired keys, returns how many'''
+    return IdempotencyKey.purge(expired_before())
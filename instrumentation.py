@@ -0,0 +1,110 @@
+import os
+import time
+from contextlib import contextmanager
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import metrics_info
+from metrics import counter, histogram, render
+
+'''
+Request instrumentation
+Every request records its latency by route, split in phases, and the number of SQL statements it ran
+    total    from before_request to teardown, the commit of the unit of work included
+    auth     token verification and permission checks of requires_auth
+    db       time spent executing SQL statements, on any engine
+    serialization  encoding of the response bodies, serialization.json_response and serialization.jsonify
+                   (the streamed /export routes encode while sending and are not covered)
+/metrics serves every metric of REGISTRY in the Prometheus text format (METRICS_ENABLED=0 turns it off)
+    the metrics are those of the worker process that answers, every sample carries its pid label
+    so the series of the workers stay apart, sum them without pid for the whole server
+    it requires a token with METRICS_PERMISSION, unless the operator lists the addresses of the
+    scrapers in METRICS_ALLOWED_ADDRESSES (empty by default)
+'''
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PHASES = ('auth', 'db', 'serialization')
+
+request_seconds = histogram('http_request_duration_seconds', 'Request latency by route and phase', LATENCY_BUCKETS,
+                            labels=('method', 'route', 'phase'))
+request_statements = histogram('http_request_sql_statements', 'SQL statements run by one request', (0, 1, 2, 3, 5, 10, 25, 50, 100),
+                               labels=('method', 'route'))
+requests_total = counter('http_requests_total', 'Requests served by route and status', labels=('method', 'route', 'status'))
+
+
+def add_phase_time(phase, seconds):
+    if has_request_context() and 'phase_seconds' in g:
+        g.phase_seconds[phase] += seconds
+
+
+@contextmanager
+def timed_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.perf_counter() - start)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['statement_start'].pop()
+    if has_request_context() and 'phase_seconds' in g:
+        g.phase_seconds['db'] += seconds
+        g.sql_statements += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def drop_statement_timer(context):
+    if context.connection is not None and context.connection.info.get('statement_start'):
+        context.connection.info['statement_start'].pop()
+
+
+def setup_instrumentation(app):
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.phase_seconds = dict.fromkeys(PHASES, 0.0)
+        g.sql_statements = 0
+
+    @app.after_request
+    def remember_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def observe_request(error=None):
+        start = g.pop('request_start', None)
+        if start is None:
+            return
+        method = request.method
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        status = 500 if error is not None else g.get('response_status', 500)
+
+        request_seconds.labels(method, route, 'total').observe(time.perf_counter() - start)
+        for phase, seconds in g.phase_seconds.items():
+            request_seconds.labels(method, route, phase).observe(seconds)
+        request_statements.labels(method, route).observe(g.sql_statements)
+        requests_total.labels(method, route, str(status)).inc()
+
+    if metrics_info['METRICS_ENABLED']:
+        # auth times its own phase with this module
+        from auth import requires_auth
+
+        def metrics_response():
+            return Response(render((('pid', str(os.getpid())),)), mimetype='text/plain; version=0.0.4')
+
+        @requires_auth(metrics_info['METRICS_PERMISSION'])
+        def authorized_metrics(jwt):
+            return metrics_response()
+
+        @app.route('/metrics', methods=['GET'])
+        def metrics():
+            if request.remote_addr in metrics_info['METRICS_ALLOWED_ADDRESSES']:
+                return metrics_response()
+            return authorized_metrics()
@@ -0,0 +1,82 @@
+import base64
+import time
+from jose import jwt
+from config import auth0_info
+
+'''
+Local token signer
+Mints RS256 tokens that auth.decode_jwt accepts, signed by a key generated in process, and
+serves the matching JWKS document, for the benchmarks and the tests. Never use it in production
+    the tokens carry the issuer and audience of auth0_info, so only the keys differ from Auth0
+    install(jwks_cache) makes a JWKSCache load the local keys instead of fetching JWKS_URL
+    the key comes from the cryptography package, pycryptodome or rsa, whichever is installed
+'''
+
+
+def generate_rsa_key(bits=2048):
+    '''returns the PEM of a new private key and the modulus and exponent of its public key'''
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa as rsa_keys
+    except ImportError:
+        pass
+    else:
+        key = rsa_keys.generate_private_key(public_exponent=65537, key_size=bits)
+        pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                serialization.NoEncryption())
+        numbers = key.public_key().public_numbers()
+        return pem, numbers.n, numbers.e
+
+    try:
+        from Crypto.PublicKey import RSA
+    except ImportError:
+        pass
+    else:
+        key = RSA.generate(bits)
+        return key.exportKey('PEM'), key.n, key.e
+
+    import rsa
+    public_key, private_key = rsa.newkeys(bits)
+    return private_key.save_pkcs1(), public_key.n, public_key.e
+
+
+def base64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class LocalSigner:
+    def __init__(self, kid='local-signer', bits=2048):
+        self.kid = kid
+        self.private_key, self.n, self.e = generate_rsa_key(bits)
+
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': base64url_uint(self.n),
+            'e': base64url_uint(self.e)
+        }]}
+
+    def token(self, *permissions, subject='local|tester', expires_in=3600, **claims):
+        now = int(time.time())
+        payload = {
+            'iss': 'https://' + auth0_info['AUTH0_DOMAIN'] + '/',
+            'sub': subject,
+            'aud': auth0_info['API_AUDIENCE'],
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.private_key, algorithm='RS256', headers={'kid': self.kid})
+
+    def bearer(self, *permissions, **kwargs):
+        return {'Authorization': 'Bearer ' + self.token(*permissions, **kwargs)}
+
+    def install(self, cache):
+        '''makes cache serve the keys of this signer, dropping the keys and tokens it had'''
+        cache.load = self.jwks
+        cache.clear()
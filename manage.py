@@ -3,6 +3,7 @@ from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db
+from idempotency import purge_expired_keys
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +11,11 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def purge_idempotency_keys():
+    '''deletes the Idempotency-Keys older than IDEMPOTENCY_TTL'''
+    print('%d expired idempotency keys deleted' % purge_expired_keys())
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,136 @@
+import threading
+from bisect import bisect_left
+
+'''
+In process metrics
+Counters and histograms shared by every request of a worker process
+    metrics are created once at import time with counter() and histogram()
+    and looked up by name in REGISTRY
+    a metric created with labels is a Family, labels(*values) returns the metric of those values
+    render() writes REGISTRY in the Prometheus text format, labels are added to every sample
+'''
+
+REGISTRY = {}
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, labels):
+        return [(self.name, labels, self.value)]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            if index < len(self.buckets):
+                self.counts[index] += 1
+
+    def cumulative_counts(self):
+        '''returns (bucket, observations <= bucket) pairs'''
+        with self._lock:
+            total = 0
+            cumulative = []
+            for bound, count in zip(self.buckets, self.counts):
+                total += count
+                cumulative.append((bound, total))
+            return cumulative
+
+    def samples(self, labels):
+        with self._lock:
+            count, total = self.count, self.sum
+        samples = [
+            (self.name + '_bucket', labels + (('le', format_value(bound)),), cumulative)
+            for bound, cumulative in self.cumulative_counts()
+        ]
+        samples.append((self.name + '_bucket', labels + (('le', '+Inf'),), count))
+        samples.append((self.name + '_sum', labels, total))
+        samples.append((self.name + '_count', labels, count))
+        return samples
+
+
+class Family:
+    def __init__(self, metric_class, name, documentation, label_names, *args):
+        self.kind = metric_class.kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._metric_class = metric_class
+        self._args = args
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._metric_class(self.name, self.documentation, *self._args))
+        return child
+
+    def samples(self, labels):
+        with self._lock:
+            children = sorted(self._children.items())
+        return [
+            sample
+            for values, child in children
+            for sample in child.samples(labels + tuple(zip(self.label_names, values)))
+        ]
+
+
+def counter(name, documentation, labels=()):
+    if labels:
+        return REGISTRY.setdefault(name, Family(Counter, name, documentation, labels))
+    return REGISTRY.setdefault(name, Counter(name, documentation))
+
+
+def histogram(name, documentation, buckets, labels=()):
+    if labels:
+        return REGISTRY.setdefault(name, Family(Histogram, name, documentation, labels, buckets))
+    return REGISTRY.setdefault(name, Histogram(name, documentation, buckets))
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(labels=()):
+    lines = []
+    for name in sorted(REGISTRY):
+        metric = REGISTRY[name]
+        lines.append('# HELP %s %s' % (name, metric.documentation.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE %s %s' % (name, metric.kind))
+        for sample_name, sample_labels, value in metric.samples(tuple(labels)):
+            if sample_labels:
+                sample_name += '{%s}' % ','.join('%s="%s"' % (key, escape(label)) for key, label in sample_labels)
+            lines.append('%s %s' % (sample_name, format_value(value)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,28 @@
+"""actors age index
+
+Revision ID: 2120cb68e5ba
+Revises: 988100038146
+Create Date: 2026-10-18 09:00:00.000000
+
+Serves the ?min_age= / ?max_age= filters and ?sort=age of GET /actors.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2120cb68e5ba'
+down_revision = '988100038146'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('actors')}
+    if 'ix_actors_age' not in existing:
+        op.create_index('ix_actors_age', 'actors', ['age'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_age', table_name='actors')
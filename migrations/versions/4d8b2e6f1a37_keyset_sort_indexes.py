@@ -0,0 +1,45 @@
+"""keyset sort indexes
+
+Revision ID: 4d8b2e6f1a37
+Revises: 9e4a1c7b3d52
+Create Date: 2026-10-18 17:00:00.000000
+
+(column, id) indexes for the ?sort= pages of GET /actors and GET /movies, which
+select WHERE (column, id) > (value, last id) ORDER BY column, id. They replace the
+single column indexes, whose filters they serve as well.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d8b2e6f1a37'
+down_revision = '9e4a1c7b3d52'
+branch_labels = None
+depends_on = None
+
+
+# (composite index, table, columns, replaced single column index)
+INDEXES = (
+    ('ix_actors_name_id', 'actors', ['name', 'id'], 'ix_actors_name'),
+    ('ix_actors_age_id', 'actors', ['age', 'id'], 'ix_actors_age'),
+    ('ix_movies_title_id', 'movies', ['title', 'id'], 'ix_movies_title'),
+    ('ix_movies_release_date_id', 'movies', ['release_date', 'id'], 'ix_movies_release_date'),
+)
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for name, table, columns, replaced in INDEXES:
+        existing = {index['name'] for index in inspector.get_indexes(table)}
+        if name not in existing:
+            op.create_index(name, table, columns, unique=False)
+        if replaced in existing:
+            op.drop_index(replaced, table_name=table)
+
+
+def downgrade():
+    for name, table, columns, replaced in reversed(INDEXES):
+        op.create_index(replaced, table, columns[:1], unique=False)
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,36 @@
+"""search indexes
+
+Revision ID: 5b2f0e7c4a91
+Revises: 2120cb68e5ba
+Create Date: 2026-10-18 10:00:00.000000
+
+GIN indexes over the tsvector of movies.title and actors.name for GET /search.
+Creating an index builds it over every existing row, so no separate backfill
+is needed and later writes keep it current. The expressions must stay identical
+to search.search_vector(). Postgres only, other databases use the in memory
+fallback index of search.py.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2f0e7c4a91'
+down_revision = '2120cb68e5ba'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute("CREATE INDEX IF NOT EXISTS ix_movies_title_search ON movies USING gin (to_tsvector('simple', coalesce(title, '')))")
+    op.execute("CREATE INDEX IF NOT EXISTS ix_actors_name_search ON actors USING gin (to_tsvector('simple', coalesce(name, '')))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('DROP INDEX IF EXISTS ix_actors_name_search')
+    op.execute('DROP INDEX IF EXISTS ix_movies_title_search')
@@ -0,0 +1,41 @@
+"""table versions
+
+Revision ID: 7c3d9e1f2a60
+Revises: 5b2f0e7c4a91
+Create Date: 2026-10-18 12:00:00.000000
+
+One version row per table, bumped by every commit that writes to the table.
+GET endpoints build their ETag and Last-Modified from it. The rows are seeded
+so the first write to a table is an update and not an insert race.
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c3d9e1f2a60'
+down_revision = '5b2f0e7c4a91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'table_versions' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    table_versions = op.create_table('table_versions',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_versions, [
+        {'table_name': table_name, 'version': 1, 'updated_at': now}
+        for table_name in ('movies', 'actors', 'performance')
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
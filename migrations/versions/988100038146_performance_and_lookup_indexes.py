@@ -0,0 +1,53 @@
+"""performance and lookup indexes
+
+Revision ID: 988100038146
+Revises: daf7c9804c17
+Create Date: 2026-10-18 08:05:00.000000
+
+Indexes the performance foreign keys so cascade deletes and cast/filmography
+lookups stop scanning the table, makes (movie_id, actor_id) unique and indexes
+the title/name/release_date lookups. Duplicate performances have to be removed
+before upgrading or the unique index cannot be built.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '988100038146'
+down_revision = 'daf7c9804c17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases created by db.create_all() with the current models already have these indexes
+    inspector = sa.inspect(op.get_bind())
+    existing = {
+        index['name']
+        for table in ('performance', 'movies', 'actors')
+        for index in inspector.get_indexes(table)
+    }
+
+    def create_index(name, table, columns, **kwargs):
+        if name not in existing:
+            op.create_index(name, table, columns, **kwargs)
+
+    create_index('uq_performance_movie_actor', 'performance', ['movie_id', 'actor_id'], unique=True)
+    create_index('ix_performance_actor_id', 'performance', ['actor_id'], unique=False)
+    create_index('ix_movies_title', 'movies', ['title'], unique=False)
+    create_index('ix_movies_release_date', 'movies', ['release_date'], unique=False)
+    create_index('ix_actors_name', 'actors', ['name'], unique=False)
+    create_index('ix_movies_title_pattern', 'movies', ['title'], unique=False, postgresql_ops={'title': 'varchar_pattern_ops'})
+    create_index('ix_actors_name_pattern', 'actors', ['name'], unique=False, postgresql_ops={'name': 'varchar_pattern_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_actors_name_pattern', table_name='actors')
+    op.drop_index('ix_movies_title_pattern', table_name='movies')
+    op.drop_index('ix_actors_name', table_name='actors')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_movies_title', table_name='movies')
+    op.drop_index('ix_performance_actor_id', table_name='performance')
+    op.drop_index('uq_performance_movie_actor', table_name='performance')
@@ -0,0 +1,38 @@
+"""idempotency keys
+
+Revision ID: 9e4a1c7b3d52
+Revises: 7c3d9e1f2a60
+Create Date: 2026-10-18 15:00:00.000000
+
+Responses of the create and batch requests sent with an Idempotency-Key header,
+replayed when the request is retried. The created_at index serves the expiry purge.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4a1c7b3d52'
+down_revision = '7c3d9e1f2a60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'idempotency_keys' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table('idempotency_keys',
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('request_hash', sa.String(length=64), nullable=False),
+    sa.Column('status', sa.Integer(), nullable=True),
+    sa.Column('body', sa.LargeBinary(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_idempotency_keys_created_at'), 'idempotency_keys', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_idempotency_keys_created_at'), table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
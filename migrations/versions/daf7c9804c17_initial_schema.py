@@ -0,0 +1,55 @@
+"""initial schema
+
+Revision ID: daf7c9804c17
+Revises: 
+Create Date: 2026-10-18 08:00:00.000000
+
+Databases that were set up with db.create_all() already have these tables,
+so each table is only created when it is missing.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'daf7c9804c17'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'movies' not in tables:
+        op.create_table('movies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=True),
+            sa.Column('release_date', sa.Date(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'actors' not in tables:
+        op.create_table('actors',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=True),
+            sa.Column('age', sa.Integer(), nullable=True),
+            sa.Column('gender', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'performance' not in tables:
+        op.create_table('performance',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('rating', sa.Integer(), nullable=True),
+            sa.Column('movie_id', sa.Integer(), nullable=False),
+            sa.Column('actor_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ),
+            sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('performance')
+    op.drop_table('actors')
+    op.drop_table('movies')
@@ -1,9 +1,20 @@
 import os
-from sqlalchemy import Table, ForeignKey, Column, Integer, Boolean, String, Date, Float, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import time
+import threading
+import base64
+import binascii
+from contextlib import contextmanager
+from itertools import chain
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy import exc, Table, ForeignKey, Column, Index, Integer, Boolean, String, Date, DateTime, Float, LargeBinary, create_engine, event, and_, tuple_
+from sqlalchemy import orm
+from flask import g, request, current_app, has_app_context, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 import json
-from datetime import date
-from config import database_info
+from datetime import date, datetime
+from config import database_info, pool_info, replica_info
+from metrics import counter, histogram
 
 '''
 Set up the database to be able to Run CRUD on tables
@@ -11,18 +22,260 @@ Set up the database to be able to Run CRUD on tables
 
 database_path = os.environ.get('DATABASE_URL', "postgres://{}:{}@{}/{}".format(database_info["db_user"], database_info["db_password"], database_info["db_location"], database_info["db_name"]))
 
-db = SQLAlchemy()
+'''
+Read replicas
+with DATABASE_REPLICA_URLS set, the reads of GET and HEAD requests go to one replica, picked in turn
+for each request, and everything else (writes, flushes, other methods, scripts) to the primary
+    after a commit that wrote, the caller (the sub of its token) reads from the primary for
+    REPLICA_STICKY_SECONDS so it sees its own writes despite the replication lag
+    the sticky window is kept in process, a caller whose next request lands on another worker
+    may read from a replica that is behind
+'''
+
+class ReplicaRouter:
+    def __init__(self, sticky_seconds=5):
+        self.sticky_seconds = sticky_seconds
+        self._next = 0
+        self._sticky_until = {}
+        self._lock = threading.Lock()
+
+    def choose(self, keys):
+        with self._lock:
+            key = keys[self._next % len(keys)]
+            self._next += 1
+            return key
+
+    def stick(self, subject):
+        with self._lock:
+            now = time.monotonic()
+            # drop the windows that are over so the dict stays as small as the recent writers
+            self._sticky_until = {key: until for key, until in self._sticky_until.items() if until > now}
+            self._sticky_until[subject] = now + self.sticky_seconds
+
+    def is_sticky(self, subject):
+        return self._sticky_until.get(subject, 0) > time.monotonic()
+
+    def replica_keys(self):
+        '''the bind keys of the replicas the current request may read from'''
+        if not has_request_context() or request.method not in ('GET', 'HEAD'):
+            return None
+        keys = current_app.config.get('REPLICA_BINDS')
+        if not keys:
+            return None
+        principal = g.get('principal')
+        if principal is not None and self.is_sticky(principal.subject):
+            return None
+        return keys
+
+    def tables_changed(self, tables):
+        principal = g.get('principal') if has_app_context() else None
+        if principal is not None and principal.subject:
+            self.stick(principal.subject)
+
+    def clear(self):
+        with self._lock:
+            self._sticky_until.clear()
+
+
+replica_router = ReplicaRouter(replica_info['REPLICA_STICKY_SECONDS'])
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing:
+            keys = replica_router.replica_keys()
+            if keys:
+                # one replica per session, so the reads of a request see one snapshot
+                if self.info.get('replica') not in keys:
+                    self.info['replica'] = replica_router.choose(keys)
+                return get_state(self.app).db.get_engine(self.app, bind=self.info['replica'])
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+'''
+Connection pool
+every worker process has its own pool, sized and tuned by pool_info in config.py
+    the time a request waits to check out a connection is recorded in db_pool_checkout_seconds
+'''
+
+db_pool_checkout_seconds = histogram('db_pool_checkout_seconds', 'Time spent waiting for a database connection from the pool',
+                                     (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+db_pool_timeouts = counter('db_pool_timeouts_total', 'Connection checkouts that gave up after DB_POOL_TIMEOUT')
+
+
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            db_pool_timeouts.inc()
+            raise
+        finally:
+            db_pool_checkout_seconds.observe(time.perf_counter() - start)
+
+
+def engine_options(database_path):
+    url = make_url(database_path)
+    options = {'pool_pre_ping': pool_info['DB_POOL_PRE_PING']}
+
+    if pool_info['DB_EXTERNAL_POOLER']:
+        options['poolclass'] = NullPool
+    elif url.get_backend_name() != 'sqlite' or url.database not in (None, '', ':memory:'):
+        # an in memory sqlite database lives in its single connection, it keeps the default pool
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=pool_info['DB_POOL_SIZE'],
+            max_overflow=pool_info['DB_MAX_OVERFLOW'],
+            pool_timeout=pool_info['DB_POOL_TIMEOUT'],
+            pool_recycle=pool_info['DB_POOL_RECYCLE'],
+        )
+
+    if pool_info['DB_STATEMENT_TIMEOUT'] and url.get_backend_name() in ('postgres', 'postgresql'):
+        options['connect_args'] = {'options': '-c statement_timeout=%d' % pool_info['DB_STATEMENT_TIMEOUT']}
+    return options
+
 
 '''
-setup_db(app, database_path=database_path)
+setup_db(app, database_path=database_path, replica_urls=None)
 binds a flask application to a SQLAlchemy service
+    it does no database I/O, the engine connects on the first query and the schema is
+    created and upgraded only by the migrations: python manage.py db upgrade
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_urls=None):
+    if replica_urls is None:
+        replica_urls = replica_info['DATABASE_REPLICA_URLS']
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    app.config["SQLALCHEMY_BINDS"] = {'replica_%d' % index: url for index, url in enumerate(replica_urls)}
+    app.config["REPLICA_BINDS"] = sorted(app.config["SQLALCHEMY_BINDS"])
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+'''
+dispose_engines(app)
+closes the pooled connections of the primary and replica engines of app, a forked process
+must not use the connections it inherited
+'''
+def dispose_engines(app):
+    db.get_engine(app).dispose()
+    for key in app.config.get('REPLICA_BINDS', ()):
+        db.get_engine(app, bind=key).dispose()
+
+'''
+Unit of work
+Model methods only stage their changes in the session (and flush them so ids and
+constraint errors are available right away). The session is committed once:
+    at the end of every request that did not fail, see setup_unit_of_work(app)
+    at the end of a with unit_of_work(): block in scripts and tests
+'''
+
+db_commits = counter('db_commits_total', 'Database transactions committed')
+db_commits_per_request = histogram('db_commits_per_request', 'Database transactions committed by one request', (0, 1, 2, 3, 5, 10))
+
+
+@event.listens_for(db.session, 'after_commit')
+def count_commit(session):
+    db_commits.inc()
+    if has_app_context():
+        g.db_commits = g.get('db_commits', 0) + 1
+
+
+@contextmanager
+def unit_of_work():
+    session = db.session
+    depth = session.info.get('unit_of_work_depth', 0)
+    session.info['unit_of_work_depth'] = depth + 1
+    try:
+        yield session
+        # nested blocks leave the commit to the outermost one
+        if depth == 0:
+            session.commit()
+    except:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        session.info['unit_of_work_depth'] = depth
+
+
+def setup_unit_of_work(app):
+    @app.before_request
+    def begin_unit_of_work():
+        g.db_commits = 0
+
+    @app.after_request
+    def commit_unit_of_work(response):
+        if response.status_code < 400:
+            db.session.commit()
+        else:
+            db.session.rollback()
+        return response
+
+    @app.teardown_request
+    def end_unit_of_work(error=None):
+        if error is not None:
+            db.session.rollback()
+        if 'db_commits' in g:
+            db_commits_per_request.observe(g.db_commits)
+
+'''
+Change notifications
+after a commit every callback registered with on_tables_changed(callback) is called
+with the set of table names the transaction wrote to
+    ORM writes are collected when they are flushed, bulk writes call touch_tables()
+'''
+
+_table_change_callbacks = []
+
+
+def on_tables_changed(callback):
+    _table_change_callbacks.append(callback)
+
+
+on_tables_changed(replica_router.tables_changed)
+
+
+def touch_tables(session, *table_names):
+    session.info.setdefault('touched_tables', set()).update(table_names)
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_touched_tables(session, flush_context):
+    touch_tables(session, *{
+        instance.__tablename__
+        for instance in chain(session.new, session.dirty, session.deleted)
+    })
+
+
+@event.listens_for(db.session, 'before_commit')
+def bump_table_versions(session):
+    # pending changes are flushed first so their tables are known
+    session.flush()
+    tables = session.info.get('touched_tables')
+    if tables:
+        TableVersion.bump(session, tables)
+
+
+@event.listens_for(db.session, 'after_commit')
+def notify_tables_changed(session):
+    tables = session.info.pop('touched_tables', None)
+    if tables:
+        for callback in _table_change_callbacks:
+            callback(tables)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_touched_tables(session):
+    session.info.pop('touched_tables', None)
 
 '''
 db_drop_and_create_all()
@@ -42,13 +295,139 @@ def db_init_values():
     new_actor = (Actors(name='Jamie Merriam', gender="Male", age=26))
     new_performance = (Performance(rating=95, movie_id=new_movie.id, movie=new_movie, actor_id=new_actor.id, actor=new_actor))
 
-    new_movie.create()
-    new_actor.create()
-    new_performance.create()
-    db.session.commit()
+    with unit_of_work():
+        new_movie.create()
+        new_actor.create()
+        new_performance.create()
 
 
 
+'''
+keyset_page(query, column, after=None, limit=None, descending=False)
+returns one page of query ordered by column and the cursor of the next page
+    ties are broken by id, so rows are selected with WHERE (column, id) > after ORDER BY column, id LIMIT limit + 1
+    and the (column, id) index is used instead of scanning past an OFFSET
+    NULLs sort as the largest value, so the rows with a NULL column are read by id in a separate
+    query that only runs once the rows with a value are used up
+    descending reverses the whole order, ties included
+    after is a cursor decoded with decode_cursor, the next cursor is None on the last page
+    a limit of None returns every row
+'''
+def keyset_page(query, column, after=None, limit=None, descending=False):
+    id_column = column.class_.id
+    if column.key == id_column.key:
+        if after is not None:
+            query = query.filter(id_column < after if descending else id_column > after)
+        return take_page([query.order_by(id_column.desc() if descending else id_column)], column, limit)
+
+    values = query.filter(column.isnot(None)).order_by(*((column.desc(), id_column.desc()) if descending else (column, id_column)))
+    nulls = query.filter(column.is_(None)).order_by(id_column.desc() if descending else id_column)
+    if after is None:
+        sections = [nulls, values] if descending else [values, nulls]
+    else:
+        value, last_id = after
+        if value is None:
+            nulls = nulls.filter(id_column < last_id if descending else id_column > last_id)
+            sections = [nulls, values] if descending else [nulls]
+        else:
+            values = values.filter(keyset_after(column, id_column, value, last_id, descending))
+            sections = [values] if descending else [values, nulls]
+    return take_page(sections, column, limit)
+
+
+def keyset_after(column, id_column, value, last_id, descending):
+    '''the row value comparison (column, id) > (value, last_id), < when descending'''
+    row, cursor = tuple_(column, id_column), tuple_(value, last_id)
+    return row < cursor if descending else row > cursor
+
+
+def take_page(sections, column, limit):
+    '''reads the queries of sections in turn until limit + 1 rows are found'''
+    rows = []
+    for section in sections:
+        if limit is None:
+            rows += section.all()
+            continue
+        rows += section.limit(limit + 1 - len(rows)).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, encode_cursor(column, rows[-1])
+    return rows, None
+
+
+'''
+encode_cursor(column, row), decode_cursor(cursor, column)
+the cursor of a page sorted by id is the last id, other sorts use the urlsafe base64
+of the json [value, id] of the last row
+    decode_cursor raises ValueError for a cursor that was not made for column
+'''
+def encode_cursor(column, row):
+    if column.key == 'id':
+        return str(row.id)
+
+    value = getattr(row, column.key)
+    if isinstance(value, date):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, row.id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, column):
+    if column.key == 'id':
+        after = int(cursor)
+        if after < 0:
+            raise ValueError('invalid cursor')
+        return after
+
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, TypeError, UnicodeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(last_id, int):
+        raise ValueError('invalid cursor')
+    if value is None:
+        return value, last_id
+
+    python_type = column.type.python_type
+    if python_type is date and isinstance(value, str):
+        value = date.fromisoformat(value)
+    if not isinstance(value, python_type):
+        raise ValueError('invalid cursor')
+    return value, last_id
+
+
+'''
+insert_many(model, rows)
+inserts rows (dicts of column values) with one multi row INSERT per chunk and sets their 'id'
+    postgres reads the ids back with RETURNING, which lists them in the order of the VALUES
+    sqlite (no RETURNING in SQLAlchemy 1.3) holds the database lock for the statement, so the
+    ids of a chunk are consecutive and end at the lastrowid of the cursor
+    chunks stay below the bound parameter limit of sqlite
+'''
+INSERT_CHUNK_SIZE = 1000
+SQLITE_MAX_VARIABLES = 999
+
+
+def insert_many(model, rows):
+    table = model.__table__
+    session = db.session
+    dialect = session.get_bind().dialect.name
+    chunk_size = INSERT_CHUNK_SIZE
+    if dialect == 'sqlite' and rows:
+        chunk_size = max(1, min(chunk_size, SQLITE_MAX_VARIABLES // len(rows[0])))
+
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        if dialect == 'postgresql':
+            result = session.execute(table.insert().values(chunk).returning(table.c.id))
+            ids = [row.id for row in result]
+        else:
+            last_id = session.execute(table.insert().values(chunk)).lastrowid
+            ids = range(last_id - len(chunk) + 1, last_id + 1)
+        for row, id in zip(chunk, ids):
+            row['id'] = id
+    touch_tables(session, model.__tablename__)
+
+
 '''
 Movies Class creates the table for Movies with a foreign key relationship to actors
 '''
@@ -56,6 +435,13 @@ Movies Class creates the table for Movies with a foreign key relationship to act
 
 class Movies(db.Model):
     __tablename__ = 'movies'
+    # the pattern index serves title prefix (LIKE 'abc%') lookups on postgres
+    # the (column, id) indexes serve the keyset pages of ?sort= and the filters on column
+    __table_args__ = (
+        Index('ix_movies_title_pattern', 'title', postgresql_ops={'title': 'varchar_pattern_ops'}),
+        Index('ix_movies_title_id', 'title', 'id'),
+        Index('ix_movies_release_date_id', 'release_date', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
@@ -63,14 +449,47 @@ class Movies(db.Model):
 
     def create(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
 
     def update(self):
-        db.session.commit()
+        db.session.flush()
+
+    '''
+    create_many(rows), update_many(rows), delete_many(ids)
+    batch writes, staged like the other model methods so they commit together
+        rows are dicts of column values, create_many sets the new 'id' in each of them
+        update_many rows must contain the 'id' of the row to update
+        delete_many also deletes the performances of the deleted movies
+    '''
+    @classmethod
+    def create_many(cls, rows):
+        insert_many(cls, rows)
+
+    @classmethod
+    def update_many(cls, rows):
+        db.session.bulk_update_mappings(cls, rows)
+        touch_tables(db.session, cls.__tablename__)
+
+    @classmethod
+    def delete_many(cls, ids):
+        Performance.query.filter(Performance.movie_id.in_(ids)).delete(synchronize_session=False)
+        cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        touch_tables(db.session, cls.__tablename__, Performance.__tablename__)
+
+    @classmethod
+    def existing_ids(cls, ids):
+        return {row.id for row in cls.query.with_entities(cls.id).filter(cls.id.in_(ids))}
+
+    serialize_fields = ('id', 'title', 'release_date')
+
+    @classmethod
+    def rows(cls, fields=None):
+        '''query of the serialize fields (or of fields, a subset of them) as column tuples, see serialization.as_dicts'''
+        return db.session.query(*[getattr(cls, field) for field in fields or cls.serialize_fields])
 
     @property
     def serialize(self):
@@ -88,6 +507,13 @@ Actors Class creates the table for Actors to be tracked in the DB
 
 class Actors(db.Model):
     __tablename__ = 'actors'
+    # the pattern index serves name prefix (LIKE 'abc%') lookups on postgres
+    # the (column, id) indexes serve the keyset pages of ?sort= and the filters on column
+    __table_args__ = (
+        Index('ix_actors_name_pattern', 'name', postgresql_ops={'name': 'varchar_pattern_ops'}),
+        Index('ix_actors_name_id', 'name', 'id'),
+        Index('ix_actors_age_id', 'age', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -96,14 +522,47 @@ class Actors(db.Model):
 
     def create(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
 
     def update(self):
-        db.session.commit()
+        db.session.flush()
+
+    '''
+    create_many(rows), update_many(rows), delete_many(ids)
+    batch writes, staged like the other model methods so they commit together
+        rows are dicts of column values, create_many sets the new 'id' in each of them
+        update_many rows must contain the 'id' of the row to update
+        delete_many also deletes the performances of the deleted actors
+    '''
+    @classmethod
+    def create_many(cls, rows):
+        insert_many(cls, rows)
+
+    @classmethod
+    def update_many(cls, rows):
+        db.session.bulk_update_mappings(cls, rows)
+        touch_tables(db.session, cls.__tablename__)
+
+    @classmethod
+    def delete_many(cls, ids):
+        Performance.query.filter(Performance.actor_id.in_(ids)).delete(synchronize_session=False)
+        cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        touch_tables(db.session, cls.__tablename__, Performance.__tablename__)
+
+    @classmethod
+    def existing_ids(cls, ids):
+        return {row.id for row in cls.query.with_entities(cls.id).filter(cls.id.in_(ids))}
+
+    serialize_fields = ('id', 'name', 'age', 'gender')
+
+    @classmethod
+    def rows(cls, fields=None):
+        '''query of the serialize fields (or of fields, a subset of them) as column tuples, see serialization.as_dicts'''
+        return db.session.query(*[getattr(cls, field) for field in fields or cls.serialize_fields])
 
     @property
     def serialize(self):
@@ -122,21 +581,33 @@ class Actors(db.Model):
 '''
 Performance Table
 This table allows for the relationship of many to many for movies and actors
+An actor plays at most once in a movie. The unique (movie_id, actor_id) index also serves
+lookups and cascade deletes by movie_id, actor_id has its own index
 '''
 
 class Performance(db.Model):
     __tablename__ = 'performance'
+    __table_args__ = (
+        Index('uq_performance_movie_actor', 'movie_id', 'actor_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     rating = Column(Integer)
     movie_id = Column(Integer, ForeignKey('movies.id'), nullable=False)
     movie = db.relationship('Movies', backref=db.backref('movies', cascade="all,delete"))
-    actor_id = Column(Integer, ForeignKey('actors.id'), nullable=False)
+    actor_id = Column(Integer, ForeignKey('actors.id'), nullable=False, index=True)
     actor = db.relationship('Actors', backref=db.backref('actors', cascade="all, delete"))
 
     def create(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+
+    serialize_fields = ('id', 'rating', 'movie_id', 'actor_id')
+
+    @classmethod
+    def rows(cls, fields=None):
+        '''query of the serialize fields (or of fields, a subset of them) as column tuples, see serialization.as_dicts'''
+        return db.session.query(*[getattr(cls, field) for field in fields or cls.serialize_fields])
 
     @property
     def serialize(self):
@@ -150,9 +621,118 @@ class Performance(db.Model):
     @property
     def performance(self):
         return {
-            'actor_id': self.Actor.id,
-            'actor_name': self.Actor.name,
-            'movie_title': self.Movie.title,
+            'actor_id': self.actor.id,
+            'actor_name': self.actor.name,
+            'movie_title': self.movie.title,
             'rating': self.rating
             }
 
+
+'''
+actor_filmography(actor_id), movie_cast(movie_id)
+return the performances of an actor with their movies, or of a movie with their actors
+    as column tuples, the related rows are fetched in the same query so the cost does not grow
+    with the number of rows
+'''
+def actor_filmography(actor_id):
+    return db.session.query(Performance.movie_id, Movies.title, Movies.release_date, Performance.rating) \
+        .join(Performance.movie) \
+        .filter(Performance.actor_id == actor_id) \
+        .order_by(Movies.release_date, Movies.id) \
+        .all()
+
+
+def movie_cast(movie_id):
+    return db.session.query(Performance.actor_id, Actors.name, Actors.age, Actors.gender, Performance.rating) \
+        .join(Performance.actor) \
+        .filter(Performance.movie_id == movie_id) \
+        .order_by(Performance.rating.desc(), Actors.id) \
+        .all()
+
+
+'''
+TableVersion Table
+One row per table with a counter and timestamp that every committed write to the table bumps,
+in the same transaction as the write. GET endpoints derive their ETag and Last-Modified from it
+without querying the rows themselves.
+    the bump is the last statement before COMMIT, so writers to the same table only queue on
+    its version row for the duration of the commit, and a bump that fails fails the write
+'''
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
+
+    @classmethod
+    def bump(cls, session, table_names):
+        table = cls.__table__
+        now = datetime.utcnow()
+        # core statements, so the bump is not itself collected as a touched table
+        for table_name in sorted(table_names):
+            result = session.execute(
+                table.update()
+                .where(table.c.table_name == table_name)
+                .values(version=table.c.version + 1, updated_at=now)
+            )
+            if result.rowcount == 0:
+                session.execute(table.insert().values(table_name=table_name, version=1, updated_at=now))
+
+    @classmethod
+    def current(cls, table_names):
+        '''returns {table_name: (version, updated_at)} of the tables that have been written to'''
+        rows = db.session.query(cls.table_name, cls.version, cls.updated_at) \
+            .filter(cls.table_name.in_(table_names))
+        return {row.table_name: (row.version, row.updated_at) for row in rows}
+
+
+'''
+IdempotencyKey Table
+One row per Idempotency-Key of a create or batch request, holding the response to replay
+when the request is retried, see idempotency.py
+    key is the sha256 of the caller, method, path and header value, request_hash the sha256 of the body
+    the row is written in the transaction of the request, so it exists exactly when the writes committed
+    rows older than IDEMPOTENCY_TTL are replaced by the next request with their key or removed by purge()
+'''
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    key = Column(String(64), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    status = Column(Integer)
+    body = Column(LargeBinary)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+    @classmethod
+    def find(cls, key, expired_before):
+        table = cls.__table__
+        return db.session.execute(
+            table.select()
+            .where(and_(table.c.key == key, table.c.created_at >= expired_before))
+        ).first()
+
+    @classmethod
+    def reserve(cls, key, request_hash, expired_before):
+        '''
+        inserts the row of key, replacing an expired one
+        raises IntegrityError when another request holds key, on postgres only once that request ends
+        '''
+        table = cls.__table__
+        # core statements, so the row is not collected as a touched table
+        db.session.execute(table.delete().where(and_(table.c.key == key, table.c.created_at < expired_before)))
+        db.session.execute(table.insert().values(key=key, request_hash=request_hash, created_at=datetime.utcnow()))
+
+    @classmethod
+    def store(cls, key, status, body):
+        table = cls.__table__
+        db.session.execute(table.update().where(table.c.key == key).values(status=status, body=body))
+
+    @classmethod
+    def purge(cls, expired_before):
+        '''deletes the expired rows, returns how many'''
+        table = cls.__table__
+        with unit_of_work() as session:
+            return session.execute(table.delete().where(table.c.created_at < expired_before)).rowcount
@@ -0,0 +1,117 @@
+import json
+import logging
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import profiler_info
+
+'''
+SQL profiler
+Captures every SQL statement of a profiled request with its parameters and duration, and the
+plan of the SELECT statements slower than SLOW_QUERY_MS, then writes one json record per request
+to the casting_agency.slow_queries logger, on stderr or in the file SLOW_QUERY_LOG
+    a request is profiled when it sends the X-SQL-Profile: 1 header and its caller has the
+    SQL_PROFILER_PERMISSION permission, or for every request with SQL_PROFILER_ENABLED=1
+    on postgres the plan comes from EXPLAIN ANALYZE, which runs the statement a second time,
+    other databases give EXPLAIN QUERY PLAN
+'''
+
+PROFILE_HEADER = 'X-SQL-Profile'
+
+slow_query_log = logging.getLogger('casting_agency.slow_queries')
+slow_query_log.setLevel(logging.INFO)
+slow_query_log.propagate = False
+if profiler_info['SLOW_QUERY_LOG']:
+    slow_query_log.addHandler(logging.FileHandler(profiler_info['SLOW_QUERY_LOG']))
+else:
+    slow_query_log.addHandler(logging.StreamHandler())
+
+
+def profiling():
+    '''whether the statements of the current request are captured'''
+    if not has_request_context() or 'sql_profile' not in g:
+        return False
+    if profiler_info['SQL_PROFILER_ENABLED']:
+        return True
+    if request.headers.get(PROFILE_HEADER) != '1':
+        return False
+    principal = g.get('principal')
+    return principal is not None and profiler_info['SQL_PROFILER_PERMISSION'] in (principal.permissions or ())
+
+
+def explain(conn, statement, parameters):
+    # a raw DBAPI cursor, so the plan does not go through the engine events again
+    if conn.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE '
+    elif conn.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+    # EXPLAIN ANALYZE runs the statement again inside the transaction of the request, the
+    # savepoint keeps a failure (a statement timeout, say) from aborting that transaction
+    savepoint = conn.dialect.name == 'postgresql'
+    cursor = conn.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT sql_profile_explain')
+        cursor.execute(prefix + statement, parameters)
+        plan = [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT sql_profile_explain')
+        return plan
+    except Exception as error:
+        if savepoint:
+            cursor.execute('ROLLBACK TO SAVEPOINT sql_profile_explain')
+        return ['explain failed: %s' % error]
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_profile_timer(conn, cursor, statement, parameters, context, executemany):
+    if profiling():
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    if not conn.info.get('profile_start') or not profiling():
+        return
+    duration_ms = (time.perf_counter() - conn.info['profile_start'].pop()) * 1000
+    entry = {
+        'statement': statement,
+        'parameters': parameters,
+        'duration_ms': round(duration_ms, 3)
+    }
+    if (duration_ms >= profiler_info['SLOW_QUERY_MS'] and not executemany
+            and statement.lstrip()[:6].upper() == 'SELECT'):
+        entry['plan'] = explain(conn, statement, parameters)
+    g.sql_profile.append(entry)
+
+
+@event.listens_for(Engine, 'handle_error')
+def drop_profile_timer(context):
+    if context.connection is not None and context.connection.info.get('profile_start'):
+        context.connection.info['profile_start'].pop()
+
+
+def setup_profiler(app):
+    @app.before_request
+    def start_profile():
+        g.sql_profile = []
+
+    @app.teardown_request
+    def write_profile(error=None):
+        statements = g.pop('sql_profile', None)
+        if not statements:
+            return
+        slow_query_log.info(json.dumps({
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'subject': g.principal.subject if 'principal' in g else None,
+            'statements': len(statements),
+            'duration_ms': round(sum(entry['duration_ms'] for entry in statements), 3),
+            'slow': sum(1 for entry in statements if 'plan' in entry),
+            'queries': statements
+        }, default=str))
@@ -0,0 +1,118 @@
+import re
+import threading
+from bisect import bisect_left
+from sqlalchemy import func, literal_column
+from models import db, on_tables_changed, Movies, Actors
+
+'''
+Full text search over movie titles and actor names
+    every word of the query has to match the start of a word of the title or name
+    on postgres the match runs against the GIN expression indexes of migration 5b2f0e7c4a91
+    and results are ranked by ts_rank
+    other databases (the sqlite test runs) use FallbackIndex, an in memory inverted index
+'''
+
+WORD = re.compile(r'\w+')
+
+
+def query_words(text):
+    return [word.lower() for word in WORD.findall(text or '')]
+
+
+'''
+search_vector(column)
+the tsvector of column, it must stay identical to the indexed expression
+to_tsvector('simple', coalesce(column, '')) or postgres will not use the index
+'''
+def search_vector(column):
+    return func.to_tsvector(literal_column("'simple'"), func.coalesce(column, literal_column("''")))
+
+
+def postgres_search(model, column, words, limit, offset):
+    tsquery = func.to_tsquery(literal_column("'simple'"), ' & '.join(word + ':*' for word in words))
+    vector = search_vector(column)
+    rank = func.ts_rank(vector, tsquery)
+    return db.session.query(model, rank) \
+        .filter(vector.op('@@')(tsquery)) \
+        .order_by(rank.desc(), model.id) \
+        .limit(limit) \
+        .offset(offset) \
+        .all()
+
+
+'''
+FallbackIndex
+Inverted index of the words of one column, built from the database on first use
+and dropped when a commit writes to the table
+    rank is the share of the words of the title or name matched by the query
+'''
+class FallbackIndex:
+    def __init__(self, model, column):
+        self.model = model
+        self.column = column
+        self._index = None
+        self._lock = threading.Lock()
+        on_tables_changed(self.tables_changed)
+
+    def tables_changed(self, tables):
+        if self.model.__tablename__ in tables:
+            self._index = None
+
+    def build(self):
+        postings = {}
+        lengths = {}
+        for id, text in db.session.query(self.model.id, self.column):
+            words = query_words(text)
+            lengths[id] = len(words)
+            for word in words:
+                postings.setdefault(word, set()).add(id)
+        return db.engine, postings, sorted(postings), lengths
+
+    def get_index(self):
+        with self._lock:
+            # each test app has its own in memory database
+            if self._index is None or self._index[0] is not db.engine:
+                self._index = self.build()
+            return self._index
+
+    def search(self, words, limit, offset):
+        engine, postings, vocabulary, lengths = self.get_index()
+
+        matches = None
+        for word in words:
+            ids = set()
+            position = bisect_left(vocabulary, word)
+            while position < len(vocabulary) and vocabulary[position].startswith(word):
+                ids |= postings[vocabulary[position]]
+                position += 1
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+
+        ranks = {id: len(words) / max(lengths[id], len(words)) for id in matches}
+        page = sorted(ranks, key=lambda id: (-ranks[id], id))[offset:offset + limit]
+        rows = {row.id: row for row in self.model.query.filter(self.model.id.in_(page))}
+        return [(rows[id], ranks[id]) for id in page if id in rows]
+
+
+SEARCHABLE = {
+    'movies': (Movies, Movies.title),
+    'actors': (Actors, Actors.name),
+}
+
+fallback_indexes = {kind: FallbackIndex(model, column) for kind, (model, column) in SEARCHABLE.items()}
+
+
+'''
+search(kind, text, limit, offset)
+returns the (row, rank) pairs of the movies or actors matching text, best match first
+'''
+def search(kind, text, limit, offset):
+    words = query_words(text)
+    if not words:
+        return []
+
+    model, column = SEARCHABLE[kind]
+    if db.engine.dialect.name == 'postgresql':
+        return postgres_search(model, column, words, limit, offset)
+    return fallback_indexes[kind].search(words, limit, offset)
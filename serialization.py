@@ -0,0 +1,69 @@
+import json
+from datetime import date, datetime
+from flask import Response, jsonify as flask_jsonify
+from config import serialization_info
+from instrumentation import timed_phase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+Serialization
+Rows are selected as column tuples (see the rows() classmethod of the models) and encoded
+straight to bytes, without building ORM objects or going through jsonify
+    JSON_ENCODER=orjson uses orjson when it is installed (pip install orjson), otherwise and
+    with JSON_ENCODER=json the stdlib json module is used
+    both encoders write dates in ISO 8601 format (YYYY-MM-DD)
+'''
+
+
+def default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def json_dumps(body):
+    return json.dumps(body, default=default, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps(body):
+    return orjson.dumps(body, default=default)
+
+
+def get_encoder(name):
+    if name == 'orjson' and orjson is not None:
+        return orjson_dumps
+    return json_dumps
+
+
+dumps = get_encoder(serialization_info['JSON_ENCODER'])
+
+
+'''
+as_dicts(rows, fields=None)
+returns the column tuples of a query as dicts keyed by the column names or labels
+    with fields only those columns are kept, in that order
+'''
+def as_dicts(rows, fields=None):
+    if not rows:
+        return []
+    names = rows[0]._fields
+    if fields is None or tuple(fields) == tuple(names):
+        return [dict(zip(names, row)) for row in rows]
+    positions = [(field, names.index(field)) for field in fields]
+    return [{field: row[position] for field, position in positions} for row in rows]
+
+
+def json_response(body, status=200):
+    with timed_phase('serialization'):
+        data = dumps(body)
+    return Response(data, status=status, mimetype='application/json')
+
+
+def jsonify(*args, **kwargs):
+    '''flask.jsonify, timed as the serialization phase'''
+    with timed_phase('serialization'):
+        return flask_jsonify(*args, **kwargs)
@@ -1,44 +1,125 @@
 import os
+import base64
+import subprocess
+import sys
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import tempfile
+import threading
+import time
+from unittest import mock
+from importlib.util import find_spec
 from app import create_app
-from models import setup_db, db_drop_and_create_all, Movies, Actors, Performance
-from config import database_info, auth_tokens
+from cache import LRUBackend, response_cache
+from idempotency import purge_expired_keys
+from instrumentation import request_seconds, request_statements
+from profiler import explain, slow_query_log
+from metrics import histogram, render
+from serialization import as_dicts, json_dumps, orjson, orjson_dumps
+from local_auth import LocalSigner
+from auth import AuthError, JWKSCache, decode_jwt, jwks_cache, Principal, TokenCache, check_permissions, token_cache, verify_decode_jwt
+from models import db, db_commits, replica_router, db_pool_checkout_seconds, dispose_engines, engine_options, TimedQueuePool, db_drop_and_create_all, keyset_page, keyset_after, unit_of_work, IdempotencyKey, TableVersion, Movies, Actors, Performance
+from config import idempotency_info, metrics_info, pool_info, profiler_info, replica_info
 from datetime import date
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+# Tokens are signed by a local key whose JWKS the app reads from memory, no Auth0 access is needed
+# a small key keeps the generation fast, it only has to be accepted by jose
+
+signer = LocalSigner(bits=1024)
+signer.install(jwks_cache)
 
 # Set up Authorization Headers for RBAC testing
 
-casting_Assistant = {
-        'Authorization': auth_tokens['casting_Assistant']
-}
+casting_Assistant = signer.bearer('get:actors', 'get:movies', subject='casting_assistant')
 
-casting_Director = {
-        'Authorization': auth_tokens['casting_Director']
-}
+casting_Director = signer.bearer(
+        'delete:actors', 'get:actors', 'get:movies', 'patch:actors', 'patch:movies', 'post:actors',
+        subject='casting_director')
+
+executive_Producer = signer.bearer(
+        'delete:actors', 'delete:movies', 'get:actors', 'get:movies',
+        'patch:actors', 'patch:movies', 'post:actors', 'post:movies',
+        subject='executive_producer')
+
+# Every test app gets its own database, a new in memory sqlite database unless TEST_DATABASE_URL is set
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
 
-executive_Producer = {
-        'Authorization': auth_tokens['executive_Producer']
+
+def create_test_app(**config):
+    app = create_app(dict({'TESTING': True, 'DATABASE_URL': TEST_DATABASE_URL}, **config))
+    with app.app_context():
+        db_drop_and_create_all()
+    return app
+
+# Requests of the other test cases skip the token, as_principal stands in for its verification
+
+def as_principal(*permissions, subject = 'test'):
+    return mock.patch('auth.verify_principal', return_value=Principal({'sub': subject, 'permissions': list(permissions)}))
+
+test_bearer = {
+        'Authorization': 'Bearer test'
 }
 
-# Setup of Unittest
 
-class CastingAgencyTestCase(unittest.TestCase):
+# count_queries records the SQL statements run inside the with block, on the engine of app or,
+# without app, on every engine, the listener is removed even when the block fails
+
+class count_queries:
+
+    def __init__(self, app = None):
+        self.app = app
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        self.target = Engine
+        if self.app is not None:
+            with self.app.app_context():
+                self.target = db.engine
+        event.listen(self.target, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.target, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+class AppTestCase(unittest.TestCase):
+    '''a test app on a fresh database, with the process wide caches cleared before every test'''
 
-    #initialize the database for testing
     def setUp(self):
-        self.app = create_app()
+        response_cache.clear()
+        replica_router.clear()
+        self.app = self.create_app()
         self.client = self.app.test_client
-        self.database_name = 'casting_agency'
-        self.database_path = os.environ.get('DATABASE_URL', "postgres://{}:{}@{}/{}".format(database_info["db_user"], database_info["db_password"], database_info["db_location"], database_info["db_name"]))
-        setup_db(self.app, self.database_path)
-        db_drop_and_create_all()
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+
+    def create_app(self):
+        return create_test_app()
+
+    def get(self, url, *permissions, headers = {}, subject = 'test'):
+        '''GET url as a caller holding permissions, returns the response and its json body'''
+        with as_principal(*permissions, subject = subject):
+            res = self.client().get(url, headers = dict(test_bearer, **headers))
+        return res, res.get_json(silent = True)
+
+    def send(self, method, url, body, *permissions, headers = {}, subject = 'test'):
+        '''sends body as json with method, returns the response and its json body'''
+        with as_principal(*permissions, subject = subject):
+            res = getattr(self.client(), method)(url, json = body, headers = dict(test_bearer, **headers))
+        return res, res.get_json(silent = True)
+
+# Setup of Unittest
+
+class CastingAgencyTestCase(AppTestCase):
 
     def tearDown(self):
         pass
@@ -205,7 +286,7 @@ class CastingAgencyTestCase(unittest.TestCase):
     def test_create_new_movie(self):
         json_create_movie = {
             'title' : 'Udacity FSND',
-            'release_date' : date.today()
+            'release_date' : date.today().isoformat()
         }
 
         res = self.client().post('/movies', json = json_create_movie, headers = executive_Producer)
@@ -289,6 +370,1187 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'] , 'resource not found')
 
+# Tests for the JWKS key store
+
+def jwks_key(kid):
+    return {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n-' + kid, 'e': 'AQAB'}
+
+
+class LocalSignerTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.signer = signer
+
+    def setUp(self):
+        self.cache = JWKSCache('http://jwks.invalid/jwks.json')
+        self.signer.install(self.cache)
+
+    def test_token_is_verified_with_local_jwks(self):
+        with mock.patch('auth.jwks_cache', self.cache):
+            payload, kid = decode_jwt(self.signer.token('get:actors', subject='local|1'))
+
+        self.assertEqual(kid, self.signer.kid)
+        self.assertEqual(payload['sub'], 'local|1')
+        self.assertEqual(payload['permissions'], ['get:actors'])
+
+    def test_expired_token_is_rejected(self):
+        with mock.patch('auth.jwks_cache', self.cache):
+            with self.assertRaises(AuthError) as raised:
+                decode_jwt(self.signer.token('get:actors', expires_in=-60))
+
+        self.assertEqual(raised.exception.error['code'], 'token_expired')
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.jwks_path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.write_keys('key-1')
+        self.cache = JWKSCache('file://' + self.jwks_path, ttl=3600, min_refresh_interval=30)
+
+    def tearDown(self):
+        os.remove(self.jwks_path)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_path, 'w') as jwks_file:
+            json.dump({'keys': [jwks_key(kid) for kid in kids]}, jwks_file)
+
+    def test_keys_are_fetched_once(self):
+        for _ in range(5):
+            self.assertEqual(self.cache.get_key('key-1')['n'], 'n-key-1')
+
+        self.assertEqual(self.cache.fetch_count, 1)
+
+    def test_unknown_kid_triggers_refetch(self):
+        self.cache.get_key('key-1')
+        self.cache._last_attempt -= 60
+        self.write_keys('key-1', 'key-2')
+
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+        self.assertEqual(self.cache.fetch_count, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.cache.get_key('key-1')
+        for _ in range(5):
+            self.assertIsNone(self.cache.get_key('missing'))
+
+        self.assertEqual(self.cache.fetch_count, 1)
+
+    def test_expired_keys_are_refetched(self):
+        self.cache.get_key('key-1')
+        self.cache._fetched_at -= 3600
+        self.cache._last_attempt -= 3600
+        self.write_keys('key-2')
+
+        self.assertIsNone(self.cache.get_key('key-1'))
+        self.assertEqual(self.cache.fetch_count, 2)
+
+    def test_stale_keys_are_served_when_refetch_fails(self):
+        self.cache.get_key('key-1')
+        self.cache._fetched_at -= 3600
+        self.cache._last_attempt -= 3600
+        os.remove(self.jwks_path)
+
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.write_keys('key-1')
+
+    def test_concurrent_refetches_do_not_stampede(self):
+        threads = [threading.Thread(target=self.cache.get_key, args=('key-1',)) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.cache.fetch_count, 1)
+
+
+# Tests for the verified token cache
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TokenCache(max_size=2)
+        self.payload = {'sub': 'user', 'permissions': ['get:actors'], 'exp': time.time() + 600}
+        self.principal = Principal(self.payload)
+
+    def test_cached_payload_is_returned(self):
+        self.cache.put('token', self.principal, 'key-1')
+
+        self.assertIs(self.cache.get('token'), self.principal)
+        self.assertIsNone(self.cache.get('other-token'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_expired_payload_is_evicted(self):
+        self.payload['exp'] = time.time() - 1
+        self.cache.put('token', Principal(self.payload), 'key-1')
+
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.put('token-1', self.principal, 'key-1')
+        self.cache.put('token-2', self.principal, 'key-1')
+        self.cache.get('token-1')
+        self.cache.put('token-3', self.principal, 'key-1')
+
+        self.assertIsNotNone(self.cache.get('token-1'))
+        self.assertIsNone(self.cache.get('token-2'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_payload_without_exp_is_not_cached(self):
+        del self.payload['exp']
+        self.cache.put('token', Principal(self.payload), 'key-1')
+
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_rotated_kid_is_evicted(self):
+        handle, jwks_path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        with open(jwks_path, 'w') as jwks_file:
+            json.dump({'keys': [jwks_key('key-1')]}, jwks_file)
+        jwks = JWKSCache('file://' + jwks_path, ttl=0)
+        jwks.on_rotate(self.cache.evict_kids)
+        jwks.get_key('key-1')
+        self.cache.put('token', self.principal, 'key-1')
+
+        with open(jwks_path, 'w') as jwks_file:
+            json.dump({'keys': [jwks_key('key-2')]}, jwks_file)
+        jwks._last_attempt -= 60
+        jwks.get_key('key-2')
+        os.remove(jwks_path)
+
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_verify_decode_jwt_uses_cache(self):
+        token_cache.put('cached-token', self.principal, 'key-1')
+        try:
+            self.assertEqual(verify_decode_jwt('cached-token'), self.payload)
+        finally:
+            token_cache.clear()
+
+
+# Tests for permission checks
+
+class PrincipalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.principal = Principal({'sub': 'user', 'permissions': ['get:actors', 'get:movies']})
+
+    def test_permissions_are_a_frozenset(self):
+        self.assertEqual(self.principal.permissions, frozenset(['get:actors', 'get:movies']))
+
+    def test_require_all_of(self):
+        self.assertTrue(self.principal.require(frozenset(['get:actors', 'get:movies'])))
+        with self.assertRaises(AuthError) as error:
+            self.principal.require(frozenset(['get:actors', 'post:actors']))
+        self.assertEqual(error.exception.status_code, 403)
+
+    def test_require_any_of(self):
+        self.assertTrue(self.principal.require(frozenset(['get:actors', 'post:actors']), any_of=True))
+        with self.assertRaises(AuthError):
+            self.principal.require(frozenset(['post:actors', 'post:movies']), any_of=True)
+
+    def test_missing_permissions_claim(self):
+        with self.assertRaises(AuthError) as error:
+            check_permissions('get:actors', {'sub': 'user'})
+        self.assertEqual(error.exception.status_code, 400)
+
+    def test_check_permissions_accepts_payload(self):
+        self.assertTrue(check_permissions('get:movies', self.principal.payload))
+        with self.assertRaises(AuthError):
+            check_permissions('delete:movies', self.principal)
+
+
+# Tests for paging of the list endpoints
+
+class PaginationTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            for age in range(30, 34):
+                db.session.add(Actors(name='Actor %d' % age, age=age, gender='Female'))
+            db.session.commit()
+
+    def test_keyset_page(self):
+        with self.app.app_context():
+            actors, next_cursor = keyset_page(Actors.query, Actors.id, None, 2)
+            self.assertEqual([actor.id for actor in actors], [1, 2])
+            self.assertEqual(next_cursor, '2')
+
+            actors, next_cursor = keyset_page(Actors.query, Actors.id, 4, 2)
+            self.assertEqual([actor.id for actor in actors], [5])
+            self.assertIsNone(next_cursor)
+
+    def test_get_actors_by_page(self):
+        ids = []
+        cursor = None
+        with as_principal('get:actors'):
+            while True:
+                url = '/actors?limit=2' + ('&after=' + cursor if cursor else '')
+                data = json.loads(self.client().get(url, headers = test_bearer).data)
+                ids += [actor['id'] for actor in data['actors']]
+                cursor = data['next_cursor']
+                if cursor is None:
+                    break
+
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+    def test_get_all_actors_without_limit(self):
+        with as_principal('get:actors'):
+            data = json.loads(self.client().get('/actors', headers = test_bearer).data)
+
+        self.assertEqual(len(data['actors']), 5)
+        self.assertIsNone(data['next_cursor'])
+
+    def test_error_422_invalid_page_args(self):
+        res, data = self.get('/movies?limit=abc', 'get:movies')
+        self.assertEqual(res.status_code, 422)
+        res, data = self.get('/movies?limit=0', 'get:movies')
+        self.assertEqual(res.status_code, 422)
+
+
+# Tests for the NDJSON exports
+
+class ExportTestCase(AppTestCase):
+
+    def get_lines(self, url, *permissions):
+        with as_principal(*permissions):
+            res = self.client().get(url, headers = test_bearer)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        return [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+
+    def test_export_actors(self):
+        self.assertEqual(self.get_lines('/actors/export', 'get:actors')[0]['name'], 'Jamie Merriam')
+
+    def test_export_movies(self):
+        movies = self.get_lines('/movies/export', 'get:movies')
+
+        self.assertEqual(movies[0]['release_date'], date.today().isoformat())
+
+    def test_export_performances(self):
+        performances = self.get_lines('/performances/export', 'get:actors', 'get:movies')
+
+        self.assertEqual(performances[0]['rating'], 95)
+
+    def test_error_403_export_performances(self):
+        res, data = self.get('/performances/export', 'get:actors')
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['message'], 'Permission not found.')
+
+
+class SerializationTestCase(AppTestCase):
+
+    def test_list_dates_are_iso(self):
+        res, data = self.get('/movies', 'get:movies')
+
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(data['movies'][0], {'id': 1, 'title': 'Curious Class of FSND', 'release_date': date.today().isoformat()})
+
+    def test_as_dicts_of_column_tuples(self):
+        with self.app.app_context():
+            rows = as_dicts(Actors.rows().all())
+
+        self.assertEqual(rows, [{'id': 1, 'name': 'Jamie Merriam', 'age': 26, 'gender': 'Male'}])
+        self.assertEqual(as_dicts([]), [])
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_encoders_agree(self):
+        body = {'movies': [{'id': 1, 'title': 'Caf\u00e9', 'release_date': date(2020, 5, 19)}], 'next_cursor': None}
+
+        self.assertEqual(json.loads(orjson_dumps(body)), json.loads(json_dumps(body)))
+        self.assertIn(b'"2020-05-19"', json_dumps(body))
+
+
+class ProjectionTestCase(AppTestCase):
+
+    def test_list_fields(self):
+        res, data = self.get('/actors?fields=id,name', 'get:actors')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [{'id': 1, 'name': 'Jamie Merriam'}])
+
+    def test_list_fields_select_only_those_columns(self):
+        with count_queries(self.app) as queries:
+            res, data = self.get('/movies?fields=title', 'get:movies')
+
+        self.assertEqual(data['movies'], [{'title': 'Curious Class of FSND'}])
+        select = [statement for statement in queries.statements if 'FROM movies' in statement][-1]
+        self.assertNotIn('release_date', select)
+
+    def test_list_fields_keep_paging(self):
+        with self.app.app_context():
+            with unit_of_work():
+                db.session.add(Actors(name='Another Actor', age=40, gender='Female'))
+        res, data = self.get('/actors?fields=name&sort=-age&limit=1', 'get:actors')
+        next_res, next_data = self.get('/actors?fields=name&sort=-age&limit=1&after=' + data['next_cursor'], 'get:actors')
+
+        self.assertEqual(data['actors'], [{'name': 'Another Actor'}])
+        self.assertEqual(next_data['actors'], [{'name': 'Jamie Merriam'}])
+
+    def test_detail(self):
+        res, data = self.get('/movies/1', 'get:movies')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['title'], 'Curious Class of FSND')
+        self.assertEqual(self.get('/actors/1?fields=name', 'get:actors')[1]['actor'], {'name': 'Jamie Merriam'})
+
+    def test_error_404_detail(self):
+        self.assertEqual(self.get('/actors/12', 'get:actors')[0].status_code, 404)
+
+    def test_error_422_unknown_field(self):
+        self.assertEqual(self.get('/actors?fields=name,salary', 'get:actors')[0].status_code, 422)
+        self.assertEqual(self.get('/movies/1?fields=', 'get:movies')[0].status_code, 422)
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def test_pool_options(self):
+        with mock.patch.dict(pool_info, {'DB_POOL_SIZE': 20, 'DB_MAX_OVERFLOW': 0, 'DB_STATEMENT_TIMEOUT': 5000}):
+            options = engine_options('postgresql://localhost/casting_agency')
+
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+
+    def test_external_pooler(self):
+        with mock.patch.dict(pool_info, {'DB_EXTERNAL_POOLER': True}):
+            options = engine_options('postgresql://localhost/casting_agency')
+
+        self.assertIs(options['poolclass'], NullPool)
+        self.assertNotIn('pool_size', options)
+
+    def test_in_memory_sqlite_keeps_default_pool(self):
+        self.assertNotIn('poolclass', engine_options('sqlite://'))
+
+    def test_checkout_wait_is_measured(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine('sqlite:///' + os.path.join(directory, 'pool.db'), poolclass=TimedQueuePool, pool_size=1, max_overflow=0)
+            count = db_pool_checkout_seconds.count
+            with engine.connect() as connection:
+                connection.execute('SELECT 1')
+            engine.dispose()
+
+        self.assertEqual(db_pool_checkout_seconds.count - count, 1)
+
+    def test_dispose_engines_empties_pool(self):
+        # in memory sqlite keeps its single connection, a database file gets a real pool
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app = create_test_app(DATABASE_URL='sqlite:///' + os.path.join(directory.name, 'pool.db'))
+        with app.app_context():
+            Actors.query.count()
+            db.session.remove()
+            self.assertEqual(db.engine.pool.checkedin(), 1)
+            dispose_engines(app)
+
+            self.assertEqual(db.engine.pool.checkedin(), 0)
+
+
+class ReplicaTestCase(AppTestCase):
+
+    def create_app(self):
+        self.directory = tempfile.TemporaryDirectory()
+        replica_urls = ['sqlite:///' + os.path.join(self.directory.name, 'replica_%d.db' % index) for index in range(2)]
+        with mock.patch.dict(replica_info, {'DATABASE_REPLICA_URLS': replica_urls}):
+            return create_test_app()
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            # each replica holds one actor of its own, so the responses tell which database was read
+            for index, key in enumerate(self.app.config['REPLICA_BINDS']):
+                engine = db.get_engine(self.app, bind=key)
+                db.Model.metadata.create_all(bind=engine)
+                engine.execute(Actors.__table__.insert().values(id=1, name='Replica %d' % index, age=30, gender='Female'))
+
+    def tearDown(self):
+        with self.app.app_context():
+            for key in self.app.config['REPLICA_BINDS']:
+                db.get_engine(self.app, bind=key).dispose()
+        self.directory.cleanup()
+
+    def get_name(self, subject = 'reader'):
+        res, data = self.get('/actors', 'get:actors', headers = {'Cache-Control': 'no-cache'}, subject = subject)
+        return data['actors'][0]['name']
+
+    def test_reads_go_to_replicas_in_turn(self):
+        names = {self.get_name() for _ in range(4)}
+
+        self.assertEqual(names, {'Replica 0', 'Replica 1'})
+
+    def test_writes_go_to_primary(self):
+        res, data = self.send('post', '/actors', {'name': 'New Actor', 'age': 30, 'gender': 'Male'}, 'post:actors')
+
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 2)
+
+    def test_writer_reads_from_primary(self):
+        self.send('post', '/actors', {'name': 'New Actor', 'age': 30, 'gender': 'Male'}, 'post:actors', subject = 'writer')
+
+        self.assertEqual(self.get_name('writer'), 'Jamie Merriam')
+        self.assertTrue(self.get_name('reader').startswith('Replica'))
+
+    def test_sticky_window_ends(self):
+        replica_router.stick('writer')
+        with mock.patch.object(replica_router, 'sticky_seconds', 0):
+            replica_router.stick('writer')
+
+        self.assertTrue(self.get_name('writer').startswith('Replica'))
+
+
+class InstrumentationTestCase(AppTestCase):
+
+    def test_request_phases_and_statements(self):
+        statements = request_statements.labels('GET', '/actors/<int:id>')
+        db_seconds = request_seconds.labels('GET', '/actors/<int:id>', 'db')
+        auth_seconds = request_seconds.labels('GET', '/actors/<int:id>', 'auth')
+        count, total = statements.count, statements.sum
+        with as_principal('get:actors'):
+            self.client().get('/actors/1', headers = dict(test_bearer, **{'Cache-Control': 'no-cache'}))
+
+        self.assertEqual(statements.count - count, 1)
+        # table version lookup and actor
+        self.assertEqual(statements.sum - total, 2)
+        self.assertGreater(db_seconds.sum, 0)
+        self.assertGreater(auth_seconds.count, 0)
+
+    def test_metrics_endpoint(self):
+        self.get('/movies', 'get:movies')
+        res, data = self.get('/metrics', 'read:metrics')
+        text = res.data.decode('utf-8')
+
+        pid = 'pid="%d"' % os.getpid()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_request_duration_seconds_count{%s,method="GET",route="/movies",phase="serialization"}' % pid, text)
+        self.assertIn('http_requests_total{%s,method="GET",route="/movies",status="200"}' % pid, text)
+
+    def test_metrics_require_permission(self):
+        # the test client connects from 127.0.0.1, which is not allowed by default
+        self.assertEqual(self.client().get('/metrics').status_code, 401)
+        self.assertEqual(self.get('/metrics', 'get:movies')[0].status_code, 401)
+
+    def test_metrics_from_allowed_address(self):
+        with mock.patch.dict(metrics_info, {'METRICS_ALLOWED_ADDRESSES': ['203.0.113.7']}):
+            self.assertEqual(self.client().get('/metrics', environ_base = {'REMOTE_ADDR': '203.0.113.7'}).status_code, 200)
+            self.assertEqual(self.client().get('/metrics').status_code, 401)
+
+    def test_metrics_from_other_address_require_permission(self):
+        remote = {'REMOTE_ADDR': '203.0.113.7'}
+        self.assertEqual(self.client().get('/metrics', environ_base = remote).status_code, 401)
+        with as_principal('get:movies'):
+            self.assertEqual(self.client().get('/metrics', headers = test_bearer, environ_base = remote).status_code, 401)
+        with as_principal('read:metrics'):
+            res = self.client().get('/metrics', headers = test_bearer, environ_base = remote)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'http_requests_total', res.data)
+
+    def test_jsonify_routes_time_serialization(self):
+        serialization = request_seconds.labels('POST', '/actors', 'serialization')
+        total = serialization.sum
+        self.send('post', '/actors', {'name': 'New Actor', 'age': 30, 'gender': 'Male'}, 'post:actors')
+
+        self.assertGreater(serialization.sum, total)
+
+    def test_render_labelled_histogram(self):
+        metric = histogram('test_render_seconds', 'Render test', (0.5, 1), labels=('route',))
+        metric.labels('/a"b').observe(0.75)
+        text = render()
+
+        self.assertIn('test_render_seconds_bucket{route="/a\\"b",le="0.5"} 0', text)
+        self.assertIn('test_render_seconds_bucket{route="/a\\"b",le="1"} 1', text)
+        self.assertIn('test_render_seconds_count{route="/a\\"b"} 1', text)
+
+    def test_failed_write_is_logged(self):
+        with mock.patch.object(Actors, 'create', side_effect=RuntimeError('boom')):
+            with mock.patch.object(self.app.logger, 'exception') as log:
+                res, data = self.send('post', '/actors', {'name': 'New Actor', 'age': 30, 'gender': 'Male'}, 'post:actors')
+
+        self.assertEqual(res.status_code, 422)
+        log.assert_called_once_with('%s %s failed', 'POST', '/actors')
+
+
+class ProfilerTestCase(AppTestCase):
+
+    def get_profiles(self, *permissions, headers = {'X-SQL-Profile': '1'}):
+        with mock.patch.object(slow_query_log, 'info') as log:
+            with as_principal(*permissions):
+                res = self.client().get('/movies?title=Curious', headers = dict(test_bearer, **headers))
+        self.assertEqual(res.status_code, 200)
+        return [json.loads(call[0][0]) for call in log.call_args_list]
+
+    def test_header_with_permission_profiles(self):
+        profiles = self.get_profiles('get:movies', 'profile:sql')
+
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['path'], '/movies?title=Curious')
+        query = [query for query in profiles[0]['queries'] if 'FROM movies' in query['statement']][0]
+        self.assertIn('Curious', query['parameters'])
+        self.assertGreaterEqual(query['duration_ms'], 0)
+        self.assertNotIn('plan', query)
+
+    def test_header_without_permission_is_ignored(self):
+        self.assertEqual(self.get_profiles('get:movies'), [])
+
+    def test_permission_without_header_is_ignored(self):
+        self.assertEqual(self.get_profiles('get:movies', 'profile:sql', headers = {}), [])
+
+    def test_slow_select_is_explained(self):
+        with mock.patch.dict(profiler_info, {'SQL_PROFILER_ENABLED': True, 'SLOW_QUERY_MS': 0}):
+            profiles = self.get_profiles('get:movies', headers = {})
+
+        query = [query for query in profiles[0]['queries'] if 'FROM movies' in query['statement']][0]
+        self.assertTrue(query['plan'])
+        self.assertEqual(profiles[0]['slow'], len(profiles[0]['queries']))
+
+    def test_failed_explain_rolls_back_to_savepoint(self):
+        # postgres aborts the transaction of the request when EXPLAIN ANALYZE fails
+        def execute(statement, *args):
+            if statement.startswith('EXPLAIN'):
+                raise Exception('canceling statement due to statement timeout')
+        cursor = mock.Mock()
+        cursor.execute.side_effect = execute
+        conn = mock.Mock()
+        conn.dialect.name = 'postgresql'
+        conn.connection.cursor.return_value = cursor
+
+        plan = explain(conn, 'SELECT 1', ())
+
+        self.assertEqual(plan, ['explain failed: canceling statement due to statement timeout'])
+        self.assertEqual([call[0][0] for call in cursor.execute.call_args_list], [
+            'SAVEPOINT sql_profile_explain',
+            'EXPLAIN ANALYZE SELECT 1',
+            'ROLLBACK TO SAVEPOINT sql_profile_explain',
+        ])
+
+
+class StartupTestCase(unittest.TestCase):
+
+    def test_create_app_runs_no_sql(self):
+        with count_queries() as queries:
+            app = create_app({'TESTING': True, 'DATABASE_URL': TEST_DATABASE_URL})
+            self.assertEqual(app.test_client().get('/').status_code, 200)
+
+        self.assertEqual(queries.statements, [])
+
+
+class AsyncAppTestCase(unittest.TestCase):
+
+    @unittest.skipIf(find_spec('gevent') is None or find_spec('psycogreen') is None, 'gevent and psycogreen are not installed')
+    def test_serves_from_patched_process(self):
+        # in a separate process, the patches of async_app must not leak into the other tests
+        code = (
+            'import async_app, socket, gevent.socket\n'
+            'assert socket.socket is gevent.socket.socket\n'
+            'assert async_app.app.test_client().get("/").status_code == 200\n'
+        )
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
+
+        self.assertEqual(result.returncode, 0, result.stdout.decode('utf-8', 'replace'))
+
+
+# Tests for the batch endpoints
+
+class BatchTestCase(AppTestCase):
+
+    def test_create_actors(self):
+        actors = [{'name': 'Actor %d' % i, 'age': 20 + i, 'gender': 'Female'} for i in range(3)]
+        res, data = self.send('post', '/actors/batch', actors, 'post:actors')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['id'] for result in data['actors']], [2, 3, 4])
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 4)
+
+    def test_create_inserts_with_one_statement(self):
+        actors = [{'name': 'Actor %d' % i, 'age': 20 + i, 'gender': 'Female'} for i in range(5)]
+        with count_queries(self.app) as queries:
+            res, data = self.send('post', '/actors/batch', actors, 'post:actors')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['id'] for result in data['actors']], [2, 3, 4, 5, 6])
+        self.assertEqual(len([statement for statement in queries.statements if statement.startswith('INSERT INTO actors')]), 1)
+        with self.app.app_context():
+            self.assertEqual([actor.name for actor in Actors.query.order_by(Actors.id)][1:], [actor['name'] for actor in actors])
+
+    def test_create_chunks_stay_below_sqlite_parameter_limit(self):
+        actors = [{'name': 'Actor %d' % i, 'age': 20 + i % 50, 'gender': 'Female'} for i in range(700)]
+        res, data = self.send('post', '/actors/batch', actors, 'post:actors')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'][-1]['id'], 701)
+        with self.app.app_context():
+            self.assertEqual(Actors.query.get(701).name, 'Actor 699')
+
+    def test_error_422_create_actors_writes_nothing(self):
+        actors = [{'name': 'Actor', 'age': 20, 'gender': 'Female'}, {'name': 'Actor', 'age': 'old'}]
+        res, data = self.send('post', '/actors/batch', actors, 'post:actors')
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['results'], [{'index': 1, 'error': 'age is invalid'}])
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 1)
+
+    def test_error_422_wrong_types_are_not_coerced(self):
+        actors = [
+            {'name': {'x': 1}, 'age': 30, 'gender': 'Female'},
+            {'name': 'Actor', 'age': 30.9, 'gender': 'Female'},
+            {'name': 'Actor', 'age': 30, 'gender': ['F']},
+            {'name': 'Actor', 'age': True, 'gender': 'Female'},
+        ]
+        res, data = self.send('post', '/actors/batch', actors, 'post:actors')
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['results'], [
+            {'index': 0, 'error': 'name is invalid'},
+            {'index': 1, 'error': 'age is invalid'},
+            {'index': 2, 'error': 'gender is invalid'},
+            {'index': 3, 'error': 'age is invalid'},
+        ])
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 1)
+
+    def test_error_422_boolean_ids(self):
+        res, data = self.send('patch', '/actors/batch', [{'id': True, 'name': 'Renamed'}], 'patch:actors')
+        self.assertEqual(data['results'], [{'index': 0, 'error': 'id is invalid'}])
+
+        res, data = self.send('delete', '/actors/batch', [True], 'delete:actors')
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['results'], [{'index': 0, 'error': 'id is invalid'}])
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 1)
+
+    def test_update_movies(self):
+        movies = [{'id': 1, 'title': 'New Title', 'release_date': '2020-05-19'}]
+        res, data = self.send('patch', '/movies/batch', movies, 'patch:movies')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'], [{'index': 0, 'id': 1, 'status': 'updated'}])
+        with self.app.app_context():
+            movie = Movies.query.get(1)
+            self.assertEqual(movie.title, 'New Title')
+            self.assertEqual(movie.release_date, date(2020, 5, 19))
+
+    def test_error_422_release_date_must_be_iso(self):
+        for release_date in ('5', 'May 19 2020', 20200519):
+            res, data = self.send('post', '/movies', {'title': 'Fuzzy', 'release_date': release_date}, 'post:movies')
+            self.assertEqual(res.status_code, 422)
+            res, data = self.send('patch', '/movies/1', {'release_date': release_date}, 'patch:movies')
+            self.assertEqual(res.status_code, 422)
+            res, data = self.send('post', '/movies/batch', [{'title': 'Fuzzy', 'release_date': release_date}], 'post:movies')
+            self.assertEqual(data['results'], [{'index': 0, 'error': 'release_date is invalid'}])
+
+        res, data = self.send('post', '/movies', {'title': 'Exact', 'release_date': '2020-05-19'}, 'post:movies')
+        self.assertEqual(data['movies'][0]['release_date'], '2020-05-19')
+
+    def test_error_422_update_missing_movie(self):
+        res, data = self.send('patch', '/movies/batch', [{'id': 1}, {'id': 99, 'title': 'Missing'}], 'patch:movies')
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['results'], [{'index': 1, 'error': 'resource not found'}])
+
+    def test_delete_movies(self):
+        res, data = self.send('delete', '/movies/batch', [1], 'delete:movies')
+
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(Movies.query.count(), 0)
+            self.assertEqual(Performance.query.count(), 0)
+
+    def test_error_403_batch_requires_single_item_permission(self):
+        res, data = self.send('delete', '/actors/batch', [1], 'delete:movies')
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['message'], 'Permission not found.')
+
+
+# Tests for the Idempotency-Key header
+
+class IdempotencyTestCase(AppTestCase):
+
+    def post(self, url, body, key, *permissions, subject = 'test'):
+        return self.send('post', url, body, *permissions, headers = {'Idempotency-Key': key}, subject = subject)[0]
+
+    def count(self, model):
+        with self.app.app_context():
+            return model.query.count()
+
+    def test_retry_replays_response_without_writing(self):
+        actor = {'name': 'Retried Actor', 'age': 30, 'gender': 'Female'}
+        first = self.post('/actors', actor, 'key-1', 'post:actors')
+        with count_queries(self.app) as queries:
+            retry = self.post('/actors', actor, 'key-1', 'post:actors')
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(self.count(Actors), 2)
+        self.assertFalse([statement for statement in queries.statements if 'actors' in statement.lower()])
+
+    def test_batch_retry_creates_rows_once(self):
+        movies = [{'title': 'Movie %d' % i, 'release_date': '2020-01-0%d' % (i + 1)} for i in range(3)]
+        first = self.post('/movies/batch', movies, 'batch-1', 'post:movies')
+        retry = self.post('/movies/batch', movies, 'batch-1', 'post:movies')
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(json.loads(retry.data), json.loads(first.data))
+        self.assertEqual(self.count(Movies), 4)
+
+    def test_error_422_same_key_different_body(self):
+        self.post('/actors', {'name': 'Actor', 'age': 30, 'gender': 'Female'}, 'key-1', 'post:actors')
+        res = self.post('/actors', {'name': 'Other', 'age': 31, 'gender': 'Male'}, 'key-1', 'post:actors')
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(self.count(Actors), 2)
+
+    def test_keys_are_scoped_to_caller_and_route(self):
+        actor = {'name': 'Actor', 'age': 30, 'gender': 'Female'}
+        self.post('/actors', actor, 'key-1', 'post:actors', subject='worker-1')
+        other_caller = self.post('/actors', actor, 'key-1', 'post:actors', subject='worker-2')
+        other_route = self.post('/actors/batch', [actor], 'key-1', 'post:actors', subject='worker-1')
+
+        self.assertNotIn('Idempotent-Replayed', other_caller.headers)
+        self.assertNotIn('Idempotent-Replayed', other_route.headers)
+        self.assertEqual(self.count(Actors), 4)
+
+    def test_failed_request_does_not_keep_key(self):
+        res = self.post('/actors', {'name': 'Actor'}, 'key-1', 'post:actors')
+        self.assertEqual(res.status_code, 422)
+
+        res = self.post('/actors', {'name': 'Actor', 'age': 30, 'gender': 'Female'}, 'key-1', 'post:actors')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.count(Actors), 2)
+
+    def test_expired_key_runs_request_again(self):
+        actor = {'name': 'Actor', 'age': 30, 'gender': 'Female'}
+        self.post('/actors', actor, 'key-1', 'post:actors')
+        with mock.patch.dict(idempotency_info, {'IDEMPOTENCY_TTL': -1}):
+            res = self.post('/actors', actor, 'key-1', 'post:actors')
+            with self.app.app_context():
+                purged = purge_expired_keys()
+
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+        self.assertEqual(self.count(Actors), 3)
+        self.assertEqual(purged, 1)
+
+    def test_without_key_every_request_writes(self):
+        actor = {'name': 'Actor', 'age': 30, 'gender': 'Female'}
+        for _ in range(2):
+            self.send('post', '/actors', actor, 'post:actors')
+
+        self.assertEqual(self.count(Actors), 3)
+        with self.app.app_context():
+            self.assertEqual(IdempotencyKey.query.count(), 0)
+
+
+# Tests for the unit of work
+
+class UnitOfWorkTestCase(AppTestCase):
+
+    def test_request_commits_once(self):
+        commits = db_commits.value
+        res, data = self.send('post', '/actors', {'name': 'Actor', 'age': 30, 'gender': 'Male'}, 'post:actors')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor'][0]['id'], 2)
+        self.assertEqual(db_commits.value - commits, 1)
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 2)
+
+    def test_failed_request_is_rolled_back(self):
+        res, data = self.send('patch', '/movies/1', {'title': 'Changed', 'release_date': 'not a date'}, 'patch:movies')
+
+        self.assertEqual(res.status_code, 422)
+        with self.app.app_context():
+            self.assertNotEqual(Movies.query.get(1).title, 'Changed')
+
+    def test_unit_of_work_commits_at_outermost_block(self):
+        commits = db_commits.value
+        with self.app.app_context():
+            with unit_of_work():
+                Actors(name='Outer', age=40, gender='Female').create()
+                with unit_of_work():
+                    Actors(name='Inner', age=41, gender='Female').create()
+                self.assertEqual(db_commits.value, commits)
+
+            self.assertEqual(db_commits.value - commits, 1)
+            self.assertEqual(Actors.query.count(), 3)
+
+    def test_unit_of_work_rolls_back_on_error(self):
+        with self.app.app_context():
+            with self.assertRaises(ValueError):
+                with unit_of_work():
+                    Actors(name='Rolled Back', age=40, gender='Female').create()
+                    raise ValueError()
+
+            self.assertEqual(Actors.query.count(), 1)
+
+
+# Tests for filmography and cast
+
+class PerformanceTestCase(AppTestCase):
+
+    def add_cast(self, size):
+        with self.app.app_context():
+            movie = Movies.query.get(1)
+            for i in range(size):
+                db.session.add(Performance(rating=i, movie=movie, actor=Actors(name='Actor %d' % i, age=20, gender='Female')))
+            db.session.commit()
+
+    def test_actor_movies(self):
+        res, data = self.get('/actors/1/movies', 'get:actors', 'get:movies')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['name'], 'Jamie Merriam')
+        self.assertEqual(data['movies'][0]['title'], 'Curious Class of FSND')
+        self.assertEqual(data['movies'][0]['rating'], 95)
+
+    def test_movie_actors_query_count_is_fixed(self):
+        with count_queries(self.app) as small_cast:
+            self.get('/movies/1/actors', 'get:actors', 'get:movies')
+        self.add_cast(20)
+        with count_queries(self.app) as large_cast:
+            res, data = self.get('/movies/1/actors', 'get:actors', 'get:movies')
+
+        self.assertEqual(len(data['actors']), 21)
+        self.assertEqual(data['actors'][0]['name'], 'Jamie Merriam')
+        # table version lookup, movie and cast
+        self.assertEqual(small_cast.count, 3)
+        self.assertEqual(large_cast.count, 3)
+
+    def test_error_404_movie_actors(self):
+        res, data = self.get('/movies/12/actors', 'get:actors', 'get:movies')
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_performance_property(self):
+        with self.app.app_context():
+            performance = Performance.query.get(1)
+            self.assertEqual(performance.performance['actor_name'], 'Jamie Merriam')
+
+
+# Tests for filtering and sorting of the list endpoints
+
+class FilterSortTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            for name, age, gender in (('Ann', 30, 'Female'), ('Andy', None, 'Male'), ('Bob', 30, 'Male'), ('Cleo', 45, 'Female')):
+                db.session.add(Actors(name=name, age=age, gender=gender))
+            db.session.add(Movies(title='Another Movie', release_date=date(1999, 1, 1)))
+            db.session.commit()
+
+    def get_all_pages(self, url):
+        names = []
+        cursor = None
+        while True:
+            res, data = self.get(url + ('&after=' + cursor if cursor else ''), 'get:actors')
+            names += [actor['name'] for actor in data['actors']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                return names
+
+    def test_filter_actors(self):
+        res, data = self.get('/actors?gender=Female&min_age=31', 'get:actors')
+
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Cleo'])
+
+    def test_filter_actors_by_name_prefix(self):
+        res, data = self.get('/actors?name=An&sort=name', 'get:actors')
+
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Andy', 'Ann'])
+
+    def test_filter_movies_by_release_date(self):
+        res, data = self.get('/movies?released_before=2000-01-01', 'get:movies')
+
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Another Movie'])
+
+    def test_error_422_release_date_filter_must_be_iso(self):
+        for url in ('/movies?released_after=5', '/movies?released_before=Jan 1 2000', '/movies?released_after=2000-13-01'):
+            res, data = self.get(url, 'get:movies')
+
+            self.assertEqual(res.status_code, 422, url)
+
+    def test_sort_by_age_pages_through_ties_and_nulls(self):
+        self.assertEqual(self.get_all_pages('/actors?sort=age&limit=2'), ['Jamie Merriam', 'Ann', 'Bob', 'Cleo', 'Andy'])
+        self.assertEqual(self.get_all_pages('/actors?sort=-age&limit=2'), ['Andy', 'Cleo', 'Bob', 'Ann', 'Jamie Merriam'])
+
+    def test_sorted_page_seeks_the_column_id_index(self):
+        with self.app.app_context():
+            for descending in (False, True):
+                query = Actors.query.filter(keyset_after(Actors.age, Actors.id, 30, 1, descending))
+                query = query.order_by(*((Actors.age.desc(), Actors.id.desc()) if descending else (Actors.age, Actors.id)))
+                sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+                plan = ' '.join(row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN ' + sql))
+
+                self.assertIn('(actors.age, actors.id) ' + ('<' if descending else '>') + ' (30, 1)', sql)
+                self.assertNotIn(' OR ', sql)
+                self.assertIn('SEARCH actors USING', plan)
+                self.assertIn('ix_actors_age_id', plan)
+
+    def test_error_422_unknown_sort(self):
+        res, data = self.get('/actors?sort=gender', 'get:actors')
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_error_422_invalid_filter(self):
+        res, data = self.get('/actors?min_age=old', 'get:actors')
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_error_422_out_of_range_filter(self):
+        for url in ('/actors?min_age=99999999999999999999999', '/actors?max_age=-2147483649', '/actors?after=99999999999999999999999'):
+            res, data = self.get(url, 'get:actors')
+
+            self.assertEqual(res.status_code, 422)
+
+    def test_error_422_invalid_cursor_value(self):
+        for url, value in (('/actors?sort=age', 10 ** 30), ('/actors?sort=age', True), ('/actors?sort=age', 'old'), ('/actors?sort=name', 5),
+                           ('/movies?sort=release_date', '2000-13-01'), ('/movies?sort=release_date', 20000101)):
+            cursor = base64.urlsafe_b64encode(json.dumps([value, 1]).encode('utf-8')).decode('ascii')
+            res, data = self.get(url + '&after=' + cursor, 'get:actors', 'get:movies')
+
+            self.assertEqual(res.status_code, 422, (url, value))
+
+    def test_error_422_invalid_cursor(self):
+        res, data = self.get('/actors?sort=name&after=not-a-cursor', 'get:actors')
+
+        self.assertEqual(res.status_code, 422)
+
+
+# Tests for search
+
+class SearchTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            for title in ('The Curious Case', 'Curious George', 'Case Closed'):
+                db.session.add(Movies(title=title, release_date=date(2000, 1, 1)))
+            db.session.commit()
+
+    def test_search_ranks_matches(self):
+        res, data = self.get('/search?q=curious', 'get:movies', 'get:actors')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Curious George', 'The Curious Case', 'Curious Class of FSND'])
+        self.assertEqual(data['actors'], [])
+
+    def test_search_matches_word_prefixes(self):
+        res, data = self.get('/search?q=cur cas&type=movies', 'get:movies')
+
+        self.assertEqual([movie['title'] for movie in data['movies']], ['The Curious Case'])
+
+    def test_search_pages(self):
+        res, data = self.get('/search?q=curious&limit=2', 'get:movies')
+        self.assertEqual(data['next_offset'], 2)
+        res, data = self.get('/search?q=curious&limit=2&offset=2', 'get:movies')
+
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Curious Class of FSND'])
+        self.assertIsNone(data['next_offset'])
+
+    def test_search_only_readable_kinds(self):
+        res, data = self.get('/search?q=jamie', 'get:actors')
+
+        self.assertNotIn('movies', data)
+        self.assertEqual(data['actors'][0]['name'], 'Jamie Merriam')
+
+    def test_search_index_follows_writes(self):
+        self.get('/search?q=again', 'get:movies')
+        with self.app.app_context():
+            with unit_of_work():
+                Movies(title='Curious Again', release_date=date(2001, 1, 1)).create()
+        res, data = self.get('/search?q=again', 'get:movies')
+
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Curious Again'])
+
+    def test_error_422_search_without_words(self):
+        res, data = self.get('/search?q=%20!', 'get:movies')
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_error_422_search_unknown_type(self):
+        res, data = self.get('/search?q=curious&type=bogus', 'get:movies')
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_error_422_search_offset_out_of_range(self):
+        for offset in ('-1', '10001', '99999999999999999999999'):
+            res, data = self.get('/search?q=curious&offset=' + offset, 'get:movies')
+
+            self.assertEqual(res.status_code, 422)
+
+
+# Tests for the response cache
+
+class ResponseCacheTestCase(AppTestCase):
+
+    def test_second_request_is_a_hit(self):
+        hits = response_cache.stats()['hits']
+        first, first_data = self.get('/actors', 'get:actors')
+        second, second_data = self.get('/actors', 'get:actors')
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first_data, second_data)
+        self.assertEqual(response_cache.stats()['hits'] - hits, 1)
+
+    def test_key_includes_arguments_and_permissions(self):
+        self.get('/actors', 'get:actors')
+
+        self.assertEqual(self.get('/actors?limit=1', 'get:actors')[0].headers['X-Cache'], 'MISS')
+        self.assertEqual(self.get('/actors', 'get:actors', 'get:movies')[0].headers['X-Cache'], 'MISS')
+
+    def test_write_invalidates_table(self):
+        self.get('/actors', 'get:actors')
+        self.get('/movies', 'get:movies')
+        self.send('post', '/actors', {'name': 'New Actor', 'age': 30, 'gender': 'Male'}, 'post:actors')
+
+        res, data = self.get('/actors', 'get:actors')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(data['actors']), 2)
+        self.assertEqual(self.get('/movies', 'get:movies')[0].headers['X-Cache'], 'HIT')
+
+    def test_write_from_other_process_invalidates(self):
+        # another worker commits to the same database file, this worker's session is not involved
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        url = 'sqlite:///' + os.path.join(directory.name, 'shared.db')
+        self.app = create_test_app(DATABASE_URL=url)
+        self.client = self.app.test_client
+        first = self.get('/actors', 'get:actors')[0]
+
+        engine = create_engine(url)
+        with engine.begin() as connection:
+            connection.execute("UPDATE actors SET name = 'Renamed'")
+            connection.execute("UPDATE table_versions SET version = version + 1 WHERE table_name = 'actors'")
+        engine.dispose()
+
+        res, data = self.get('/actors', 'get:actors')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertNotEqual(res.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(data['actors'][0]['name'], 'Renamed')
+        self.assertEqual(self.get('/actors', 'get:actors', headers = {'If-None-Match': first.headers['ETag']})[0].status_code, 200)
+
+    def test_no_cache_header_bypasses(self):
+        self.get('/actors', 'get:actors')
+        res, data = self.get('/actors', 'get:actors', headers = {'Cache-Control': 'no-cache'})
+
+        self.assertNotIn('X-Cache', res.headers)
+
+    def test_lru_backend_evicts_oldest(self):
+        backend = LRUBackend(max_size=1, ttl=60)
+        backend.set('first', b'1')
+        backend.set('second', b'2')
+
+        self.assertIsNone(backend.get('first'))
+        self.assertEqual(backend.get('second'), b'2')
+
+
+class ConditionalGetTestCase(AppTestCase):
+
+    def test_etag_and_last_modified(self):
+        res, data = self.get('/actors', 'get:actors')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.headers['ETag'])
+        self.assertTrue(res.headers['Last-Modified'])
+
+    def test_if_none_match_is_not_modified(self):
+        etag = self.get('/actors', 'get:actors')[0].headers['ETag']
+        with count_queries(self.app) as queries:
+            res, data = self.get('/actors', 'get:actors', headers = {'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        # only the version lookup runs
+        self.assertEqual(queries.count, 1)
+
+    def test_weak_if_none_match_is_not_modified(self):
+        etag = self.get('/actors', 'get:actors')[0].headers['ETag']
+        res, data = self.get('/actors', 'get:actors', headers = {'If-None-Match': 'W/' + etag})
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_if_none_match_star_needs_a_representation(self):
+        res, data = self.get('/actors/1', 'get:actors', headers = {'If-None-Match': '*'})
+
+        self.assertEqual(res.status_code, 304)
+
+        res, data = self.get('/actors/999', 'get:actors', headers = {'If-None-Match': '*'})
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_write_changes_etag(self):
+        etag = self.get('/actors', 'get:actors')[0].headers['ETag']
+        self.send('post', '/actors', {'name': 'New Actor', 'age': 30, 'gender': 'Male'}, 'post:actors')
+        res, data = self.get('/actors', 'get:actors', headers = {'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(len(data['actors']), 2)
+
+    def test_write_to_other_table_keeps_etag(self):
+        etag = self.get('/movies', 'get:movies')[0].headers['ETag']
+        self.send('post', '/actors', {'name': 'New Actor', 'age': 30, 'gender': 'Male'}, 'post:actors')
+
+        self.assertEqual(self.get('/movies', 'get:movies', headers = {'If-None-Match': etag})[0].status_code, 304)
+
+    def test_version_bump_shares_the_write_connection(self):
+        # a single pooled connection, a bump on a second one would wait for the pool timeout
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with mock.patch.dict(pool_info, {'DB_POOL_SIZE': 1, 'DB_MAX_OVERFLOW': 0, 'DB_POOL_TIMEOUT': 1}):
+            self.app = create_test_app(DATABASE_URL='sqlite:///' + os.path.join(directory.name, 'pool.db'))
+        self.client = self.app.test_client
+        with self.app.app_context():
+            version = TableVersion.current(['actors'])['actors'][0]
+
+        start = time.perf_counter()
+        res, data = self.send('post', '/actors', {'name': 'New Actor', 'age': 30, 'gender': 'Male'}, 'post:actors')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLess(time.perf_counter() - start, 1)
+        with self.app.app_context():
+            self.assertEqual(TableVersion.current(['actors'])['actors'][0], version + 1)
+
+    def test_failed_version_bump_fails_the_write(self):
+        with self.app.app_context():
+            with mock.patch.object(TableVersion, 'bump', side_effect=exc.OperationalError('UPDATE table_versions', {}, Exception('locked'))):
+                with self.assertRaises(exc.OperationalError):
+                    with unit_of_work():
+                        Actors(name='New Actor', age=30, gender='Male').create()
+
+            self.assertEqual(Actors.query.count(), 1)
+
+    def test_if_modified_since_is_not_modified(self):
+        last_modified = self.get('/movies', 'get:movies')[0].headers['Last-Modified']
+        res, data = self.get('/movies', 'get:movies', headers = {'If-Modified-Since': last_modified})
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_etag_includes_arguments(self):
+        etag = self.get('/movies', 'get:movies')[0].headers['ETag']
+
+        self.assertEqual(self.get('/movies?limit=1', 'get:movies', headers = {'If-None-Match': etag})[0].status_code, 200)
+
+
 # To run tests run 'python test_agency.py'
 if __name__ == "__main__":
     unittest.main()